@@ -0,0 +1,172 @@
+"""
+Check the cold-start import time of each flow entry point.
+
+Prefect workers start a fresh process for every flow run, so everything imported at module level is paid for on
+every run. Each entry point is imported in a clean interpreter with ``python -X importtime``. Absolute import times
+depend on the machine, so each one is divided by the time spent importing prefect in the same interpreter, which
+dominates it, and compared against the ratio recorded in import_time_baseline.json. Heavy dependencies that should
+only be imported inside the code paths that use them are flagged if they show up at import time.
+
+Usage
+-----
+    python check_import_time.py [--repeat N] [--tolerance FRACTION] [--record] [module ...]
+
+Exits with a non-zero status if any entry point is more than the tolerance slower than its baseline, or eagerly
+imports a heavy dependency. Run with --record to update the baseline after an intended change.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from os.path import abspath, dirname, exists, join
+
+# Flow entry points to check
+ENTRY_POINTS = [
+    "end_of_run_workflow",
+    "end_of_run_export",
+    "data_validation",
+    "process_tes",
+    "live_export",
+]
+
+# Import times are measured relative to this module, which dominates them
+REFERENCE_MODULE = "prefect"
+BASELINE_FILE = join(dirname(abspath(__file__)), "import_time_baseline.json")
+# Fraction by which an entry point may exceed its baseline ratio
+DEFAULT_TOLERANCE = 0.1
+
+# Dependencies that must not be imported when a flow module is loaded
+LAZY_MODULES = [
+    "h5py",
+    "xarray",
+    "tiled.client",
+    "autoprocess",
+]
+
+
+def measure_import(module, repeat=3):
+    """
+    Import a module in fresh interpreters and measure its cumulative import time, in seconds and relative to the
+    time spent importing REFERENCE_MODULE in the same interpreter, which cancels out most of the difference between
+    machines and runs.
+
+    Parameters
+    ----------
+    module : str
+        Name of the module to import
+    repeat : int, optional
+        Number of fresh interpreters to time, the fastest is reported
+
+    Returns
+    -------
+    elapsed : float
+        Fastest cumulative import time in seconds
+    ratio : float
+        Smallest ratio of the cumulative import time to that of REFERENCE_MODULE
+    imported : set
+        Names of all modules imported along the way
+    """
+    timings = []
+    ratios = []
+    imported = set()
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=dirname(abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Could not import {module}:\n{result.stderr}")
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line.removeprefix("import time:").split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            imported.add(name)
+            cumulative[name] = int(fields[1]) / 1e6
+        for name in (module, REFERENCE_MODULE):
+            if name not in cumulative:
+                raise RuntimeError(f"No import timing found for {name} when importing {module}")
+        timings.append(cumulative[module])
+        ratios.append(cumulative[module] / cumulative[REFERENCE_MODULE])
+    return min(timings), min(ratios), imported
+
+
+def load_baseline(filename=BASELINE_FILE):
+    """
+    Import time of each entry point relative to REFERENCE_MODULE, as recorded with --record.
+    """
+    with open(filename) as f:
+        return json.load(f)["ratios"]
+
+
+def record_baseline(ratios, filename=BASELINE_FILE):
+    with open(filename, "w") as f:
+        json.dump({"reference": REFERENCE_MODULE, "ratios": ratios}, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+
+def check_import_time(modules, baseline, repeat=3, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compare the import time of each module relative to REFERENCE_MODULE against its baseline ratio. Only heavy
+    dependencies are checked if baseline is None.
+
+    Returns
+    -------
+    failures : list of str
+        A description of each failed check
+    ratios : dict
+        Measured import time of each module relative to REFERENCE_MODULE
+    """
+    failures = []
+    ratios = {}
+    for module in modules:
+        elapsed, ratio, imported = measure_import(module, repeat)
+        ratios[module] = round(ratio, 3)
+        eager = [m for m in LAZY_MODULES if m in imported]
+        line = f"{module:<24} {elapsed:7.3f} s {ratios[module]:6.3f}x"
+        if baseline is None:
+            print(line)
+        elif module not in baseline:
+            print(f"{line} (no baseline) FAIL")
+            failures.append(f"{module} has no baseline, record one with --record")
+        else:
+            budget = baseline[module] * (1 + tolerance)
+            print(f"{line} (budget {budget:.3f}x) {'FAIL' if ratios[module] > budget or eager else 'ok'}")
+            if ratios[module] > budget:
+                failures.append(
+                    f"{module} took {ratios[module]:.3f}x as long to import as {REFERENCE_MODULE}, "
+                    f"over its {budget:.3f}x budget"
+                )
+        for m in eager:
+            failures.append(f"{module} imports {m} at module level")
+    return failures, ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check cold-start import time of flow entry points")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS, help="Modules to check")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh interpreters to time per module")
+    parser.add_argument(
+        "--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Fraction by which a baseline may be exceeded"
+    )
+    parser.add_argument("--record", action="store_true", help="Record the measured ratios as the new baseline")
+    args = parser.parse_args()
+
+    baseline = load_baseline() if exists(BASELINE_FILE) else {}
+    failures, ratios = check_import_time(args.modules, None if args.record else baseline, args.repeat, args.tolerance)
+    if args.record:
+        record_baseline({**baseline, **ratios})
+        print(f"Recorded baseline in {BASELINE_FILE}")
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import numpy as np
+
+
+class ColumnTable:
+    """
+    Named columns of run data with one row per scan point.
+
+    One-dimensional columns are stored together in a single preallocated structured array, so renaming, reordering
+    and dropping columns only changes the view of the data, never the data itself. Columns that don't fit in a row
+    (e.g. the TES spectrum, or anything with a different number of points) are kept alongside as separate arrays.
+
+    Parameters
+    ----------
+    columns : list
+        The column names, in order.
+    data : list
+        The column data, in the same order as columns.
+    """
+
+    def __init__(self, columns, data):
+        self.columns = list(columns)
+        self._arrays = {}
+        fields = []
+        npts = None
+        for name, values in zip(self.columns, data):
+            if isinstance(values, np.ndarray) and values.ndim == 1 and npts in (None, len(values)):
+                npts = len(values)
+                fields.append((name, values))
+            else:
+                self._arrays[name] = values
+        self._table = np.empty(npts or 0, dtype=[(name, values.dtype) for name, values in fields])
+        for name, values in fields:
+            self._table[name] = values
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            raise KeyError(name)
+        if name in self._arrays:
+            return self._arrays[name]
+        return self._table[name]
+
+    def items(self):
+        for name in self.columns:
+            yield name, self[name]
+
+    def index(self, name):
+        return self.columns.index(name)
+
+    def is_tabular(self, name):
+        """
+        True if the column is stored in the row table rather than as a separate array.
+        """
+        return name in self.columns and name not in self._arrays
+
+    def records(self):
+        """
+        Structured array view of the one-dimensional columns in column order, without copying.
+
+        Suitable for writing rows directly with np.savetxt.
+        """
+        return self._table[[name for name in self.columns if name not in self._arrays]]
+
+    def rename(self, name, new_name):
+        self.columns[self.columns.index(name)] = new_name
+        if name in self._arrays:
+            self._arrays[new_name] = self._arrays.pop(name)
+        else:
+            dtype = self._table.dtype
+            names = [new_name if n == name else n for n in dtype.names]
+            self._table = self._table.view(
+                np.dtype(
+                    {
+                        "names": names,
+                        "formats": [dtype.fields[n][0] for n in dtype.names],
+                        "offsets": [dtype.fields[n][1] for n in dtype.names],
+                        "itemsize": dtype.itemsize,
+                    }
+                )
+            )
+
+    def drop(self, name):
+        self.columns.remove(name)
+        self._arrays.pop(name, None)
+
+    def move(self, name, index):
+        self.columns.remove(name)
+        self.columns.insert(index, name)
+
+    def insert(self, index, name, values):
+        """
+        Insert a column before position index. Adding a one-dimensional column reallocates the row table.
+        """
+        if isinstance(values, np.ndarray) and values.ndim == 1 and len(values) == len(self):
+            tabular = [n for n in self.columns if n not in self._arrays]
+            table = np.empty(len(self), dtype=[(n, self._table.dtype[n]) for n in tabular] + [(name, values.dtype)])
+            for n in tabular:
+                table[n] = self._table[n]
+            table[name] = values
+            self._table = table
+        else:
+            self._arrays[name] = values
+        self.columns.insert(index, name)
+
+    def set_array(self, name, values):
+        """
+        Replace the data of a column that is stored as a separate array.
+        """
+        if name in self.columns and name not in self._arrays:
+            raise ValueError(f"{name} is stored in the row table")
+        self._arrays[name] = values
+
+    @classmethod
+    def empty_like(cls, other, npts):
+        """
+        Allocate a table with the same columns and dtypes as another one, but npts rows.
+
+        One-dimensional columns and separate arrays are allocated with npts entries along their first axis. Columns
+        that are not arrays are set to None and need to be filled in with set_array.
+        """
+        table = cls.__new__(cls)
+        table.columns = list(other.columns)
+        table._table = np.empty(npts, dtype=[(name, other[name].dtype) for name in other.records().dtype.names])
+        table._arrays = {}
+        for name, values in other._arrays.items():
+            if isinstance(values, np.ndarray):
+                table._arrays[name] = np.empty((npts,) + values.shape[1:], dtype=values.dtype)
+            else:
+                table._arrays[name] = None
+        return table
+
+    def set_rows(self, rows, other):
+        """
+        Copy the one-dimensional columns and array columns of another table into a block of rows of this one.
+        """
+        for name, values in other.items():
+            if name in other._arrays:
+                if isinstance(values, np.ndarray):
+                    self._arrays[name][rows] = values
+            else:
+                self._table[name][rows] = values
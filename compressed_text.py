@@ -0,0 +1,149 @@
+import gzip
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# File name suffix for each supported compression of text exports
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# Uncompressed bytes per independently compressed block. Blocks must be well under the size of a typical export, so
+# that compressing one overlaps with formatting the next rather than all happening at close.
+COMPRESSION_BLOCK_SIZE = 2**19
+COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+
+
+def get_compression(compression=None):
+    """
+    Compression for text exports, "gzip", "zstd" or None for plain text. Taken from the argument if given, otherwise
+    from the UCAL_TEXT_COMPRESSION environment variable. Plain text by default.
+    """
+    if compression is None:
+        compression = os.environ.get("UCAL_TEXT_COMPRESSION", "")
+    if compression in ("", "none"):
+        return None
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression {compression!r}, expected one of {', '.join(COMPRESSION_SUFFIXES)}")
+    return compression
+
+
+def compressed_filename(filename, compression=None):
+    """
+    Add the suffix for the compression chosen by get_compression to a file name.
+    """
+    compression = get_compression(compression)
+    if compression is None:
+        return filename
+    return filename + COMPRESSION_SUFFIXES[compression]
+
+
+def make_block_compressor(compression, level=None):
+    """
+    Function that compresses one block of bytes into a complete gzip member or zstd frame.
+
+    Concatenated gzip members and zstd frames are a valid stream of their own, which gunzip, zstd -d and the Python
+    gzip module decompress as a whole, so blocks can be compressed independently and written one after the other.
+    """
+    if level is None:
+        level = COMPRESSION_LEVELS[compression]
+    if compression == "gzip":
+        return lambda block: gzip.compress(block, compresslevel=level, mtime=0)
+    import zstandard
+
+    # Compressor objects can't be shared between threads, and a new one per block costs next to nothing
+    return lambda block: zstandard.ZstdCompressor(level=level).compress(block)
+
+
+class ParallelCompressedWriter:
+    """
+    Text file that is compressed in independent blocks on a pool of threads.
+
+    Text written to the file is encoded and collected into blocks of COMPRESSION_BLOCK_SIZE bytes, and each full block
+    is compressed on a worker thread while the next one is being filled. zlib and zstd release the GIL while they
+    compress, so compressing adds little to the time it takes to format the text. Blocks are written in order as
+    they finish, with at most two blocks per thread in flight. The result decompresses as a single standard stream,
+    see make_block_compressor.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the compressed file to write
+    compression : str
+        "gzip" or "zstd"
+    level : int, optional
+        Compression level, COMPRESSION_LEVELS by default
+    threads : int, optional
+        Number of compression threads, the number of CPUs by default
+    block_size : int, optional
+        Uncompressed bytes per block
+    """
+
+    def __init__(self, filename, compression, level=None, threads=None, block_size=COMPRESSION_BLOCK_SIZE):
+        self.name = filename
+        self.block_size = block_size
+        self._compress = make_block_compressor(compression, level)
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(self._threads, thread_name_prefix="compress")
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._file = open(filename, "wb")
+        self.closed = False
+
+    def write(self, text):
+        data = text.encode() if isinstance(text, str) else text
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+        return len(text)
+
+    def _submit(self):
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        for start in range(0, len(block), self.block_size):
+            stop = start + self.block_size
+            self._pending.append(self._executor.submit(self._compress, block[start:stop]))
+        while len(self._pending) > 2 * self._threads:
+            self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._buffered:
+                self._submit()
+            for future in self._pending:
+                self._file.write(future.result())
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._file.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_text_output(filename, compression=None):
+    """
+    Open a text export for writing, compressed with ParallelCompressedWriter if compression is set.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the file to write, including any compression suffix, see compressed_filename
+    compression : str, optional
+        "gzip", "zstd" or None, see get_compression
+
+    Returns
+    -------
+    file-like
+        A writable text file to be used as a context manager
+    """
+    compression = get_compression(compression)
+    if compression is None:
+        return open(filename, "w")
+    return ParallelCompressedWriter(filename, compression)
@@ -1,20 +1,168 @@
 from prefect import flow, get_run_logger, task
-from os.path import exists, join
+from os.path import dirname, exists, join
 import os
-from export_to_xdi import exportToXDI
-from export_to_hdf5 import exportToHDF5
-from export_tools import get_proposal_path, initialize_tiled_client
-import datetime
+from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, make_filename, write_xdi
+from export_to_hdf5 import write_hdf5, write_hdf5_chunked
+from compressed_text import compressed_filename
+from export_index import get_energy_range, get_index_path, try_update_export_index
+from export_tools import (
+    flow_run_cache_key,
+    get_export_chunk_rows,
+    get_export_path,
+    get_proposal_path,
+    initialize_tiled_client,
+    tes_data_loaded,
+    track_memory,
+)
+from profiling import profile_flow
+from contextlib import contextmanager
+import json
+import threading
+import time
 
+# Seconds between updates of the state of a running export, see exporting
+EXPORT_STATE_HEARTBEAT = 30
+# A running export whose state has not been updated for this many seconds is presumed dead
+EXPORT_STATE_STALE_AFTER = 300
 
-def get_export_path(run):
-    proposal_path = get_proposal_path(run)
 
-    visit_date = datetime.datetime.fromisoformat(run.start.get("start_datetime", datetime.datetime.today().isoformat()))
-    visit_dir = visit_date.strftime("%Y%m%d_export")
+def get_export_state_path(run):
+    """
+    File recording which flow is exporting a run. The live and end-of-run flows both claim the export through it, see
+    claim_export, so that a run is only processed and exported once.
+    """
+    return join(get_export_path(run), ".export_state", f"{run.start['uid']}.json")
 
-    export_path = join(proposal_path, visit_dir)
-    return export_path
+
+def read_export_state(path):
+    """
+    The state of a run's export, a dict with the state ("running", "published", "skipped" or "failed"), the flow that
+    owns the export and when the state was last updated. None if no flow has claimed the export.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        # Claimed, but the state is still being written
+        return {"state": "running", "owner": None, "updated": os.path.getmtime(path)}
+
+
+def write_export_state(path, state, owner):
+    partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(partial_path, "w") as f:
+        json.dump({"state": state, "owner": owner, "updated": time.time()}, f)
+    os.replace(partial_path, path)
+
+
+def claim_export(path, owner, reexport=False):
+    """
+    Claim the export of a run for a flow.
+
+    Parameters
+    ----------
+    path : str
+        The run's export state file, see get_export_state_path
+    owner : str
+        Name of the flow claiming the export, e.g. "live" or "end_of_run"
+    reexport : bool, optional
+        If True, also claim runs that another flow has published, to export them again
+
+    Returns
+    -------
+    bool
+        False if another flow is still exporting the run, i.e. has updated the state within EXPORT_STATE_STALE_AFTER
+        seconds, or if another flow has published it and reexport is False. Exports that failed, were skipped or went
+        stale can always be claimed again, and a flow can always claim a run it published itself, so running it again
+        exports the run again.
+    """
+    os.makedirs(dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return take_over_export(path, owner, reexport)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"state": "running", "owner": owner, "updated": time.time()}, f)
+    return True
+
+
+def take_over_export(path, owner, reexport=False):
+    """
+    Claim an export that has been claimed before, if its state allows it, see claim_export.
+
+    The state is read and replaced while holding a lock file created with O_EXCL, so two flows that find the same
+    failed or stale export can't both take it over. A flow that finds the lock taken does not claim the export, and
+    a lock left behind by a flow that died while holding it is removed once it is EXPORT_STATE_STALE_AFTER old.
+    """
+    lock_path = path + ".lock"
+    try:
+        os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_path) > EXPORT_STATE_STALE_AFTER:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+        return False
+    try:
+        current = read_export_state(path)
+        if current is not None:
+            if current["state"] == "published" and current["owner"] != owner and not reexport:
+                return False
+            if current["state"] == "running" and time.time() - current["updated"] < EXPORT_STATE_STALE_AFTER:
+                return False
+        write_export_state(path, "running", owner)
+        return True
+    finally:
+        os.remove(lock_path)
+
+
+@contextmanager
+def exporting(path, owner):
+    """
+    Keep the state of a claimed export up to date while it runs.
+
+    The state is refreshed every EXPORT_STATE_HEARTBEAT seconds from a background thread, so that a flow waiting for
+    the export can tell a slow export from a dead one. Set status["state"] to "published" or "skipped" on the yielded
+    status dict before leaving, otherwise the export is recorded as failed.
+    """
+    status = {"state": "running"}
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(EXPORT_STATE_HEARTBEAT):
+            write_export_state(path, "running", owner)
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield status
+    finally:
+        done.set()
+        thread.join()
+        write_export_state(path, "failed" if status["state"] == "running" else status["state"], owner)
+
+
+def wait_to_claim_export(path, owner, logger, reexport=False, poll_interval=10):
+    """
+    Claim the export of a run, waiting while another flow is still exporting it. See claim_export.
+
+    Returns
+    -------
+    dict or None
+        None once the export is claimed, otherwise the state of the other flow that published the run
+    """
+    waiting = False
+    while not claim_export(path, owner, reexport):
+        current = read_export_state(path)
+        if current is not None and current["state"] == "published" and current["owner"] != owner and not reexport:
+            return current
+        if not waiting:
+            logger.info("Waiting for another flow to finish exporting this run")
+            waiting = True
+        time.sleep(poll_interval)
+    return None
 
 
 def create_export_path(export_path):
@@ -25,29 +173,172 @@ def create_export_path(export_path):
         logger.info(f"Export path does not exist, making {export_path}")
 
 
-@task(retries=2, retry_delay_seconds=10)
-def export_all_streams(uid, beamline_acronym="ucal"):
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def create_export_paths(uid, beamline_acronym="ucal"):
     logger = get_run_logger()
     catalog = initialize_tiled_client(beamline_acronym)
     run = catalog[uid]
 
     base_export_path = get_export_path(run)
-    logger.info(f"Generating Export for uid {run.start['uid']}")
     logger.info(f"Export Data to {base_export_path}")
     create_export_path(base_export_path)
+    export_paths = {}
+    for fmt in ["xdi", "hdf5"]:
+        export_paths[fmt] = join(base_export_path, fmt)
+        create_export_path(export_paths[fmt])
+    export_paths["index"] = get_index_path(get_proposal_path(run))
+    return export_paths
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def get_export_header(uid, beamline_acronym="ucal"):
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    if "primary" not in run:
+        return None
+    return get_xdi_run_header(run)
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def write_xdi_export(export_path, uid, metadata, beamline_acronym="ucal", compression=None):
+    """
+    Fetch and normalize the run data and write it to a partial XDI file.
+
+    The run data stays inside the task, only the file names, normalized metadata and energy range are returned and
+    persisted with the task result.
+
+    Returns
+    -------
+    tuple
+        (partial_filename, filename, metadata, energy_range)
+    """
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    with track_memory("XDI fetch", logger):
+        # get_xdi_normalized_data modifies metadata in place, and the header is shared between formats
+        table, metadata = get_xdi_normalized_data(run, dict(metadata), omit_array_keys=True)
+    filename = compressed_filename(make_filename(export_path, metadata), compression)
+    partial_filename = filename + ".part"
+    with track_memory("XDI export", logger):
+        write_xdi(partial_filename, table, metadata, run.start.get("comment", ""), compression)
+    return partial_filename, filename, metadata, get_energy_range(table)
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def write_hdf5_export(export_path, uid, metadata, beamline_acronym="ucal", precision_policy=None):
+    """
+    Fetch and normalize the run data, including array keys, and write it to a partial HDF5 file. Only the file names
+    are returned.
+    """
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    with track_memory("HDF5 fetch", logger):
+        table, metadata = get_xdi_normalized_data(run, dict(metadata), omit_array_keys=False)
+    filename = make_filename(export_path, metadata, "hdf5")
+    partial_filename = filename + ".part"
+    with track_memory("HDF5 export", logger):
+        write_hdf5(partial_filename, table, metadata, precision_policy)
+    return partial_filename, filename
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def get_hdf5_chunk_rows(uid, memory_budget=None, beamline_acronym="ucal"):
+    """
+    Decide from the run's Tiled structure whether the HDF5 export fits in the memory budget.
+
+    Returns
+    -------
+    int or None
+        Rows per chunk for a chunked export, or None to export the run in one piece
+    """
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    chunk_rows = get_export_chunk_rows(run, memory_budget, omit_array_keys=False)
+    if chunk_rows is not None:
+        logger.info(f"Run is over the export memory budget, exporting HDF5 in chunks of {chunk_rows} rows")
+    return chunk_rows
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def write_hdf5_chunked_export(export_path, uid, metadata, chunk_rows, beamline_acronym="ucal", precision_policy=None):
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    filename = make_filename(export_path, metadata, "hdf5")
+    partial_filename = filename + ".part"
+    with track_memory("Chunked HDF5 export", get_run_logger()):
+        write_hdf5_chunked(partial_filename, run, metadata, chunk_rows, precision_policy)
+    return partial_filename, filename
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def publish_export(partial_filename, filename):
+    """
+    Move a finished export into place. Readers never see a partially written file.
+    """
+    logger = get_run_logger()
+    os.replace(partial_filename, filename)
+    logger.info(f"Published {filename}")
+    return filename
+
+
+@task(retries=2, retry_delay_seconds=10, persist_result=True, cache_key_fn=flow_run_cache_key)
+def index_export(index_path, fmt, filename, metadata, energy_range=None):
+    """
+    Record a published export in the proposal's export index.
+    """
+    try_update_export_index(index_path, metadata, fmt, filename, energy_range, get_run_logger())
+
+
+@flow(retries=1, retry_delay_seconds=10)
+def general_data_export(
+    uid, beamline_acronym="ucal", memory_budget=None, profile=None, precision_policy=None, text_compression=None
+):
+    """
+    Export a run to XDI and HDF5.
+
+    Each step (paths, header, one task per format, publish, index) is a separate task whose result is cached for
+    the flow run, so a retry only repeats the step that failed. Each format task fetches the run data itself, so only
+    file names and metadata are persisted as task results, never run data. Runs too large for the memory budget (see
+    get_memory_budget, which counts processed TES data) are written to HDF5 in chunks. HDF5 columns are stored at the
+    dtypes chosen by precision_policy (see get_precision_policy). Set text_compression (or UCAL_TEXT_COMPRESSION) to
+    "gzip" or "zstd" to compress the XDI file. Set profile (or UCAL_PROFILE) to save a profile of the export to the
+    profiles directory next to it.
+    """
+    logger = get_run_logger()
+    with profile_flow("general_data_export", profile, logger=logger) as flow_profile:
+        logger.info(f"Generating Export for uid {uid}")
+        metadata = get_export_header(uid, beamline_acronym)
+        if metadata is None:
+            logger.info(f"Export does not support streams other than Primary, skipping {uid}")
+            return
+        export_paths = create_export_paths(uid, beamline_acronym)
+        if flow_profile is not None:
+            flow_profile.output_dir = join(dirname(export_paths["xdi"]), "profiles")
 
-    logger.info("Exporting XDI")
-    xdi_export_path = join(base_export_path, "xdi")
-    create_export_path(xdi_export_path)
-    exportToXDI(xdi_export_path, run)
-    logger.info("Exporting HDF5")
-    hdf5_export_path = join(base_export_path, "hdf5")
-    create_export_path(hdf5_export_path)
-    exportToHDF5(hdf5_export_path, run)
-    # logger.info("Exporting Athena")
-    # exportToAthena(export_path, run)
-
-
-@flow
-def general_data_export(uid, beamline_acronym="ucal"):
-    export_all_streams(uid, beamline_acronym)
+        # Processed TES data is read once for both formats, and counted in the HDF5 chunk size estimate
+        run = initialize_tiled_client(beamline_acronym)[uid]
+        with tes_data_loaded(run, memory_budget):
+            logger.info("Exporting XDI")
+            partial_filename, xdi_filename, xdi_metadata, energy_range = write_xdi_export(
+                export_paths["xdi"], uid, metadata, beamline_acronym, text_compression
+            )
+            xdi_filename = publish_export(partial_filename, xdi_filename)
+            index_export(export_paths["index"], "xdi", xdi_filename, xdi_metadata, energy_range)
+            logger.info("Exporting HDF5")
+            chunk_rows = get_hdf5_chunk_rows(uid, memory_budget, beamline_acronym)
+            if chunk_rows is None:
+                hdf5_filename = publish_export(
+                    *write_hdf5_export(export_paths["hdf5"], uid, metadata, beamline_acronym, precision_policy)
+                )
+            else:
+                hdf5_filename = publish_export(
+                    *write_hdf5_chunked_export(
+                        export_paths["hdf5"], uid, metadata, chunk_rows, beamline_acronym, precision_policy
+                    )
+                )
+            index_export(export_paths["index"], "hdf5", hdf5_filename, xdi_metadata, energy_range)
+        # logger.info("Exporting Athena")
+        # exportToAthena(export_path, run)
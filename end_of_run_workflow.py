@@ -1,8 +1,14 @@
 from prefect import flow, get_run_logger, task
 from data_validation import general_data_validation
-from end_of_run_export import general_data_export
+from end_of_run_export import (
+    exporting,
+    general_data_export,
+    get_export_state_path,
+    wait_to_claim_export,
+)
 from process_tes import process_tes
-from export_tools import initialize_tiled_client
+from export_tools import get_profile_path, initialize_tiled_client, release_tes_data
+from profiling import profile_flow
 
 
 @task
@@ -12,23 +18,52 @@ def log_completion():
 
 
 @flow
-def end_of_run_workflow(stop_doc, reprocess_tes=False):
+def end_of_run_workflow(
+    stop_doc,
+    reprocess_tes=False,
+    memory_budget=None,
+    profile=None,
+    precision_policy=None,
+    text_compression=None,
+    reexport=False,
+):
     uid = stop_doc["run_start"]
     logger = get_run_logger()
 
-    general_data_validation(uid)
-    catalog = initialize_tiled_client("ucal")
-    run = catalog[uid]
-    if run.start.get("data_session", "") == "":
-        logger.info("No data session found, skipping export")
-        return
+    with profile_flow("end_of_run_workflow", profile, logger=logger) as flow_profile:
+        general_data_validation(uid)
+        catalog = initialize_tiled_client("ucal")
+        run = catalog[uid]
+        if run.start.get("data_session", "") == "":
+            logger.info("No data session found, skipping export")
+            return
+        if flow_profile is not None:
+            flow_profile.output_dir = get_profile_path(run)
 
-    process_tes(uid, reprocess=reprocess_tes)
-    # Here is where exporters could be added
-    exit_status = stop_doc.get("exit_status", "No Status")
-    if exit_status == "success":
-        general_data_export(uid)
-    else:
-        logger.info(f"Run had exit status: {exit_status}, skipping export")
+        # The live export may have processed and exported the run already, or still be doing so. Reprocessing or
+        # re-exporting a run it has published waits for it to finish, and then exports the run again.
+        state_path = get_export_state_path(run)
+        published = wait_to_claim_export(state_path, "end_of_run", logger, reexport=reexport or reprocess_tes)
+        if published is not None:
+            logger.info(f"Run was exported by the {published['owner']} export, skipping TES processing and export")
+        else:
+            with exporting(state_path, "end_of_run") as status:
+                try:
+                    process_tes(uid, reprocess=reprocess_tes, keep_data=True)
+                    # Here is where exporters could be added
+                    exit_status = stop_doc.get("exit_status", "No Status")
+                    if exit_status == "success":
+                        general_data_export(
+                            uid,
+                            memory_budget=memory_budget,
+                            precision_policy=precision_policy,
+                            text_compression=text_compression,
+                        )
+                        status["state"] = "published"
+                    else:
+                        logger.info(f"Run had exit status: {exit_status}, skipping export")
+                        status["state"] = "skipped"
+                finally:
+                    release_tes_data(uid)
 
     log_completion()
@@ -0,0 +1,198 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+from os.path import abspath, join
+
+import numpy as np
+from export_tools import get_proposal_path
+
+INDEX_FILENAME = "export_index.sqlite"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exports (
+    uid TEXT NOT NULL,
+    format TEXT NOT NULL,
+    scan_id INTEGER,
+    sample TEXT,
+    element TEXT,
+    edge TEXT,
+    command TEXT,
+    energy_min REAL,
+    energy_max REAL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    fingerprint TEXT,
+    exported TEXT,
+    PRIMARY KEY (uid, format)
+);
+CREATE INDEX IF NOT EXISTS exports_sample_element_edge ON exports (sample, element, edge);
+CREATE INDEX IF NOT EXISTS exports_element_edge ON exports (element, edge);
+CREATE INDEX IF NOT EXISTS exports_scan_id ON exports (scan_id);
+"""
+
+INDEX_COLUMNS = [
+    "uid",
+    "format",
+    "scan_id",
+    "sample",
+    "element",
+    "edge",
+    "command",
+    "energy_min",
+    "energy_max",
+    "path",
+    "size",
+    "fingerprint",
+    "exported",
+]
+
+
+def get_index_path(proposal_path):
+    return join(proposal_path, INDEX_FILENAME)
+
+
+def connect_index(index_path):
+    """
+    Open the export index of a proposal, creating it if needed.
+    """
+    connection = sqlite3.connect(index_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(INDEX_SCHEMA)
+    return connection
+
+
+def file_fingerprint(path, sample_size=2**16):
+    """
+    Quick fingerprint to tell whether an exported file has changed: a BLAKE2b hash of its size and of blocks sampled
+    from its start, middle and end.
+
+    At most three blocks are read however large the file is, so indexing a multi-GB HDF5 export does not read it all
+    back. This is not a checksum of the whole contents.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as f:
+        for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+            f.seek(offset)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def get_energy_range(table, key="energy"):
+    """
+    Lowest and highest energy of a ColumnTable, or None if it has no energy column.
+    """
+    if key not in table or len(table) == 0:
+        return None
+    energy = table[key]
+    return float(np.nanmin(energy)), float(np.nanmax(energy))
+
+
+def merge_energy_range(energy_range, other):
+    if energy_range is None:
+        return other
+    if other is None:
+        return energy_range
+    return min(energy_range[0], other[0]), max(energy_range[1], other[1])
+
+
+def update_export_index(index_path, metadata, fmt, path, energy_range=None):
+    """
+    Add or replace the entry for one export of a scan in the proposal's export index.
+
+    Parameters
+    ----------
+    index_path : str
+        Path of the proposal's index, see get_index_path
+    metadata : dict
+        XDI header dictionary of the scan, as returned by get_xdi_run_header
+    fmt : str
+        Export format, e.g. "xdi" or "hdf5". A scan has one entry per format.
+    path : str
+        Path of the exported file
+    energy_range : tuple, optional
+        Lowest and highest energy of the scan
+    """
+    if energy_range is None:
+        energy_range = (None, None)
+    row = {
+        "uid": metadata.get("Scan.uid"),
+        "format": fmt,
+        "scan_id": metadata.get("Scan.transient_id"),
+        "sample": metadata.get("Sample.name", ""),
+        "element": metadata.get("Element.symbol", ""),
+        "edge": metadata.get("Element.edge", ""),
+        "command": metadata.get("Scan.command", ""),
+        "energy_min": energy_range[0],
+        "energy_max": energy_range[1],
+        "path": abspath(path),
+        "size": os.path.getsize(path),
+        "fingerprint": file_fingerprint(path),
+        "exported": datetime.datetime.now().isoformat(),
+    }
+    connection = connect_index(index_path)
+    try:
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO exports ({', '.join(INDEX_COLUMNS)}) "
+                f"VALUES ({', '.join(':' + c for c in INDEX_COLUMNS)})",
+                row,
+            )
+    finally:
+        connection.close()
+
+
+def try_update_export_index(index_path, metadata, fmt, path, energy_range=None, logger=None):
+    """
+    Same as update_export_index, but only report failures, so that a problem with the index never fails an export.
+    """
+    try:
+        update_export_index(index_path, metadata, fmt, path, energy_range)
+    except (sqlite3.Error, OSError) as e:
+        message = f"Could not update export index {index_path}: {e}"
+        if logger is None:
+            print(message)
+        else:
+            logger.warning(message)
+
+
+def index_run_export(run, metadata, fmt, path, energy_range=None, logger=None):
+    """
+    Record an export in the index of the run's proposal. Runs without proposal metadata are not indexed.
+    """
+    try:
+        index_path = get_index_path(get_proposal_path(run))
+    except ValueError:
+        return
+    try_update_export_index(index_path, metadata, fmt, path, energy_range, logger)
+
+
+def find_exports(index_path, **filters):
+    """
+    Look up exports in a proposal's export index.
+
+    Parameters
+    ----------
+    index_path : str
+        Path of the proposal's index, see get_index_path
+    **filters
+        Values that index columns must equal, e.g. sample="X", element="Fe", edge="L", or uid=...
+
+    Returns
+    -------
+    list of dict
+        The matching index entries, ordered by scan id and format
+    """
+    unknown = set(filters) - set(INDEX_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown index columns: {', '.join(sorted(unknown))}")
+    query = "SELECT * FROM exports"
+    if filters:
+        query += " WHERE " + " AND ".join(f"{key} = :{key}" for key in filters)
+    query += " ORDER BY scan_id, format"
+    connection = connect_index(index_path)
+    try:
+        return [dict(row) for row in connection.execute(query, filters)]
+    finally:
+        connection.close()
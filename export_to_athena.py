@@ -1,6 +1,8 @@
 import numpy as np
 from os.path import exists, join
 from export_tools import add_comment_to_lines, get_header_and_data
+from export_index import index_run_export
+from compressed_text import compressed_filename, open_text_output
 from prefect import get_run_logger
 
 
@@ -12,7 +14,8 @@ def exportToAthena(
     c2="",
     headerUpdates={},
     strict=False,
-    verbose=True
+    verbose=True,
+    compression=None
 ):
     """Exports to Graham's ASCII SSRL data format
 
@@ -23,6 +26,7 @@ def exportToAthena(
     :param c1: Comment string 1
     :param c2: Comment string 2
     :param headerUpdates: Manual updates for header dictionary (helpful to fill missing info)
+    :param compression: "gzip" or "zstd" to write a compressed file (suffix added to the filename), see get_compression
     :returns:
     :rtype:
 
@@ -31,7 +35,7 @@ def exportToAthena(
     logger.info("Getting athena header and data")
     header, data = get_header_and_data(run)
 
-    filename = join(folder, namefmt.format(**header["scaninfo"]))
+    filename = compressed_filename(join(folder, namefmt.format(**header["scaninfo"])), compression)
 
     metadata = {}
     metadata.update(header["scaninfo"])
@@ -53,8 +57,8 @@ def exportToAthena(
     cols = channelinfo.get("cols")
     colStr = " ".join(cols)
 
-    metadata["npts"] = data.shape[0]
-    metadata["ncols"] = data.shape[1]
+    metadata["npts"] = len(data)
+    metadata["ncols"] = len(cols)
     metadata["cols"] = colStr
     metadata["c1"] = c1
     metadata["c2"] = c2
@@ -76,7 +80,22 @@ Scan: {scan}
     )
     headerstring = add_comment_to_lines(headerstring, "#")
     logger.info(f"Writing Athena to {filename}")
-    with open(filename, "w") as f:
+    with open_text_output(filename, compression) as f:
         f.write(headerstring)
         f.write("\n")
         np.savetxt(f, data, fmt=" %8.8e")
+
+    energy_range = None
+    for key in ["en_energy_setpoint", "en_energy"]:
+        if key in cols:
+            energy_range = (float(np.nanmin(data[key])), float(np.nanmax(data[key])))
+            break
+    index_metadata = {
+        "Scan.uid": run.start["uid"],
+        "Scan.transient_id": run.start["scan_id"],
+        "Sample.name": metadata["sample"],
+        "Element.symbol": run.start.get("element", ""),
+        "Element.edge": run.start.get("edge", ""),
+        "Scan.command": metadata["command"],
+    }
+    index_run_export(run, index_metadata, "athena", filename, energy_range, logger)
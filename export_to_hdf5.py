@@ -1,9 +1,17 @@
-import h5py
+import json
+import os
+import numpy as np
+from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, iter_xdi_normalized_chunks, make_filename
+from export_tools import get_export_chunk_rows, get_run_length, tes_data_loaded
+from export_index import get_energy_range, index_run_export, merge_energy_range
+from rixs_data import RIXSData
+from precision import apply_precision, choose_dtype, get_precision_policy, merge_precision
 
-from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, make_filename
+# Largest block copied at once when a dataset is rewritten at another dtype
+CONVERT_BLOCK_BYTES = 2**26
 
 
-def exportToHDF5(folder, run, header_updates={}):
+def exportToHDF5(folder, run, header_updates={}, memory_budget=None, precision_policy=None):
     """
     Export a run to an HDF5 file.
 
@@ -11,32 +19,322 @@ def exportToHDF5(folder, run, header_updates={}):
     ----------
     run : Run
     folder : str
+    header_updates : dict
+    memory_budget : int or str, optional
+        Runs estimated to need more memory than this are written in chunks, see get_memory_budget
+    precision_policy : str or dict, optional
+        How columns are stored, see get_precision_policy
     """
-
     if "primary" not in run:
         print(f"HDF5 Export does not support streams other than Primary, skipping {run.start['scan_id']}")
         return False
     metadata = get_xdi_run_header(run, header_updates)
     print("Got XDI Metadata")
     filename = make_filename(folder, metadata, "hdf5")
+
+    with tes_data_loaded(run, memory_budget):
+        chunk_rows = get_export_chunk_rows(run, memory_budget, omit_array_keys=False)
+        if chunk_rows is not None:
+            energy_range = write_hdf5_chunked(filename, run, metadata, chunk_rows, precision_policy)
+            index_run_export(run, metadata, "hdf5", filename, energy_range)
+            return True
+
+        table, metadata = get_xdi_normalized_data(run, metadata, omit_array_keys=False)
+        write_hdf5(filename, table, metadata, precision_policy)
+    index_run_export(run, metadata, "hdf5", filename, get_energy_range(table))
+
+    return True
+
+
+def write_hdf5(filename, table, metadata, precision_policy=None):
+    """
+    Write normalized run data to an HDF5 file.
+
+    Columns are stored at the dtype chosen by the precision policy. The policy is stored in the precision_policy
+    file attribute, and the policy applied to each column, its source dtype and any rounding error in the attributes
+    of its dataset.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the HDF5 file to write.
+    table : ColumnTable
+        The run data, as returned by get_xdi_normalized_data.
+    metadata : dict
+        The XDI header dictionary, stored as file attributes.
+    precision_policy : str or dict, optional
+        How columns are stored, see get_precision_policy
+    """
+    import h5py
+
+    policy = get_precision_policy(precision_policy)
     print(f"Exporting HDF5 to {filename}")
+    with h5py.File(filename, "w") as f:
+        for name, data in table.items():
+            write_column(f, name, data, policy)
+        for key, value in metadata.items():
+            f.attrs[key] = value
+        f.attrs["precision_policy"] = json.dumps(policy)
 
-    columns, run_data, metadata = get_xdi_normalized_data(run, metadata, omit_array_keys=False)
 
+def write_hdf5_chunked(filename, run, metadata, chunk_rows, precision_policy=None):
+    """
+    Write a run to an HDF5 file a block of rows at a time, so that only one block of the run is in memory.
+
+    The dtype of each column is chosen block by block and merged, see ensure_dataset and finish_datasets, so the file
+    holds the same data at the same dtypes as the one written by write_hdf5.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the HDF5 file to write.
+    run : Run
+    metadata : dict
+        The XDI header dictionary, as returned by get_xdi_run_header.
+    chunk_rows : int
+        Number of rows (scan points) to read and write at a time.
+    precision_policy : str or dict, optional
+        How columns are stored, see get_precision_policy
+
+    Returns
+    -------
+    tuple or None
+        Lowest and highest energy of the run, see get_energy_range
+    """
+    import h5py
+
+    policy = get_precision_policy(precision_policy)
+    npts = get_run_length(run)
+    energy_range = None
+    chosen = {}
+    print(f"Exporting HDF5 to {filename} in chunks of {chunk_rows} rows")
     with h5py.File(filename, "w") as f:
-        for name, data in zip(columns, run_data):
-            if name == "rixs":
-                if len(data) == 3:
-                    counts, mono_grid, energy_grid = data
-                    g = f.create_group("rixs")
-                    g.create_dataset("motor_values", data=mono_grid[0, :])
-                    g.create_dataset("emission_energies", data=energy_grid[:, 0])
-                    g.create_dataset("counts", data=counts)
+        for rows, table, chunk_metadata in iter_xdi_normalized_chunks(run, metadata, chunk_rows, omit_array_keys=False):
+            energy_range = merge_energy_range(energy_range, get_energy_range(table))
+            for name, data in table.items():
+                if name == "rixs" and isinstance(data, RIXSData):
+                    counts = data.counts
+                    if name not in f:
+                        g = f.create_group("rixs")
+                        g.create_dataset("motor_values", shape=(npts,), dtype=data.motor_values.dtype)
+                        g.create_dataset("emission_energies", data=data.emission_energies)
+                    ensure_dataset(
+                        f, "rixs/counts", *choose_dtype(name, counts, policy), chosen, shape=(counts.shape[0], npts)
+                    )
+                    f["rixs/motor_values"][rows] = data.motor_values
+                    f["rixs/counts"][:, rows] = counts
                 else:
-                    f.create_dataset(name, data=data)
+                    ensure_dataset(f, name, *choose_dtype(name, data, policy), chosen, shape=(npts,) + data.shape[1:])
+                    f[name][rows] = data
+        finish_datasets(f, chosen)
+        for key, value in chunk_metadata.items():
+            f.attrs[key] = value
+        f.attrs["precision_policy"] = json.dumps(policy)
+    return energy_range
+
+
+class LiveHDF5Writer:
+    """
+    Append rows to an HDF5 export while the run is still in progress.
+
+    Every column is a resizable dataset that grows as rows arrive, so finalize only has to add the metadata. Columns
+    that only exist once the run has finished, such as processed TES data, are written whole with add_columns.
+
+    Parameters
+    ----------
+    filename : str
+        Final path of the HDF5 file.
+    precision_policy : str or dict, optional
+        How columns are stored, see get_precision_policy. The dtypes chosen for each block of rows are merged as in
+        write_hdf5_chunked, and the datasets converted to them by finalize.
+    """
+
+    def __init__(self, filename, precision_policy=None):
+        import h5py
+
+        self.filename = filename
+        self.policy = get_precision_policy(precision_policy)
+        self.columns = None
+        self._chosen = {}
+        self._partial_filename = filename + ".part"
+        self._file = h5py.File(self._partial_filename, "w")
+
+    def append(self, table):
+        """
+        Append a block of rows, normalized by get_xdi_normalized_data.
+        """
+        if self.columns is None:
+            self.columns = list(table.columns)
+        elif list(table.columns) != self.columns:
+            raise ValueError(f"HDF5 columns changed from {self.columns} to {table.columns} during the run")
+        f = self._file
+        for name, data in table.items():
+            if name == "rixs" and isinstance(data, RIXSData):
+                counts = data.counts
+                if name not in f:
+                    g = f.create_group("rixs")
+                    g.create_dataset("motor_values", shape=(0,), maxshape=(None,), dtype=data.motor_values.dtype)
+                    g.create_dataset("emission_energies", data=data.emission_energies)
+                ensure_dataset(
+                    f,
+                    "rixs/counts",
+                    *choose_dtype(name, counts, self.policy),
+                    self._chosen,
+                    shape=(counts.shape[0], 0),
+                    maxshape=(counts.shape[0], None),
+                )
+                append_to_dataset(f["rixs/motor_values"], data.motor_values)
+                append_to_dataset(f["rixs/counts"], counts, axis=1)
             else:
-                f.create_dataset(name, data=data)
+                ensure_dataset(
+                    f,
+                    name,
+                    *choose_dtype(name, data, self.policy),
+                    self._chosen,
+                    shape=(0,) + data.shape[1:],
+                    maxshape=(None,) + data.shape[1:],
+                )
+                append_to_dataset(f[name], data)
+        f.flush()
+
+    def add_columns(self, table):
+        """
+        Add columns for every row appended so far, such as processed TES data that only exists once the run has
+        finished. Columns of the same name that were appended are replaced.
+
+        Parameters
+        ----------
+        table : ColumnTable
+            The columns to add, normalized by get_xdi_normalized_data for the whole run.
+        """
+        for name, data in table.items():
+            if name in self._file:
+                del self._file[name]
+            for dataset_name in [key for key in self._chosen if key == name or key.startswith(name + "/")]:
+                del self._chosen[dataset_name]
+            write_column(self._file, name, data, self.policy)
+            if name not in self.columns:
+                self.columns.append(name)
+
+    def finalize(self, metadata):
+        """
+        Write the metadata and close the file.
+
+        Returns
+        -------
+        str
+            Path of the finished partial file, to be moved to self.filename
+        """
+        finish_datasets(self._file, self._chosen)
         for key, value in metadata.items():
-            f.attrs[key] = value
+            self._file.attrs[key] = value
+        self._file.attrs["precision_policy"] = json.dumps(self.policy)
+        self._file.close()
+        return self._partial_filename
 
-    return True
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self._partial_filename):
+            os.remove(self._partial_filename)
+
+
+def append_to_dataset(dataset, data, axis=0):
+    start = dataset.shape[axis]
+    dataset.resize(start + data.shape[axis], axis=axis)
+    index = [slice(None)] * dataset.ndim
+    index[axis] = slice(start, None)
+    dataset[tuple(index)] = data
+
+
+def write_column(group, name, data, policy):
+    """
+    Write a whole column to a new dataset, or to a group of datasets for RIXSData.
+    """
+    if name == "rixs" and isinstance(data, RIXSData):
+        g = group.create_group("rixs")
+        g.create_dataset("motor_values", data=data.motor_values)
+        g.create_dataset("emission_energies", data=data.emission_energies)
+        create_dataset(g, "counts", data.counts, name, policy)
+    else:
+        create_dataset(group, name, data, name, policy)
+
+
+def create_dataset(group, name, data, column, policy):
+    """
+    Create a dataset holding a column at the dtype chosen by the precision policy, see choose_dtype.
+    """
+    data, attrs = apply_precision(column, data, policy)
+    dataset = group.create_dataset(name, data=data)
+    dataset.attrs.update(attrs)
+    return dataset
+
+
+def ensure_dataset(group, name, dtype, attrs, chosen, **kwargs):
+    """
+    Make sure a dataset that is written a block of rows at a time can hold the next block.
+
+    The dtype and attrs chosen for the block are merged into those chosen for the earlier blocks in chosen[name], see
+    merge_precision. Integer dtypes hold their values exactly, so the dataset is created at the integer dtype chosen
+    for the first block, and rewritten at a wider dtype if a later block needs one. Rounding to float32 is only
+    allowed once every block is known to be within the error bound, so float columns are written at their source
+    dtype and only converted by finish_datasets.
+
+    Parameters
+    ----------
+    group : h5py.Group
+    name : str
+        Path of the dataset within the group
+    dtype : np.dtype
+        The dtype chosen for the block, see choose_dtype
+    attrs : dict
+        The attributes chosen for the block, see choose_dtype
+    chosen : dict
+        The dtype and attrs chosen so far for each dataset, updated in place
+    **kwargs
+        Passed on to create_dataset, e.g. shape and maxshape
+    """
+    if name in chosen:
+        dtype, attrs = merge_precision(*chosen[name], dtype, attrs)
+    chosen[name] = (dtype, attrs)
+    if dtype.kind == "f":
+        dtype = np.promote_types(dtype, attrs["source_dtype"])
+    if name not in group:
+        return group.create_dataset(name, dtype=dtype, **kwargs)
+    dataset = group[name]
+    if np.promote_types(dataset.dtype, dtype) != dataset.dtype:
+        dataset = convert_dataset(group, name, np.promote_types(dataset.dtype, dtype))
+    return dataset
+
+
+def finish_datasets(group, chosen):
+    """
+    Convert the datasets written with ensure_dataset to the dtypes chosen for all their blocks, and store the
+    precision attrs.
+
+    Converting rewrites the dataset, and HDF5 does not reclaim the space of the source-dtype copy. That only adds
+    noticeably to the file size for multi-dimensional columns stored as float32.
+    """
+    for name, (dtype, attrs) in chosen.items():
+        dataset = group[name]
+        if dataset.dtype != dtype:
+            dataset = convert_dataset(group, name, dtype)
+        dataset.attrs.update(attrs)
+
+
+def convert_dataset(group, name, dtype):
+    """
+    Rewrite a dataset at another dtype, copying its data a block at a time.
+    """
+    old = group[name]
+    partial_name = name + ".converted"
+    kwargs = {"chunks": old.chunks, "maxshape": old.maxshape} if old.chunks is not None else {}
+    new = group.create_dataset(partial_name, shape=old.shape, dtype=dtype, **kwargs)
+    row_bytes = max(1, old.dtype.itemsize * int(np.prod(old.shape[1:])))
+    step = max(1, CONVERT_BLOCK_BYTES // row_bytes)
+    for start in range(0, old.shape[0], step):
+        block = slice(start, start + step)
+        new[block] = old[block]
+    new.attrs.update(old.attrs)
+    del group[name]
+    group.move(partial_name, name)
+    return group[name]
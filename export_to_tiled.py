@@ -1,5 +1,7 @@
-from export_to_xdi import get_xdi_normalized_data, get_xdi_run_header, make_filename
-import xarray as xr
+from export_to_xdi import get_xdi_normalized_data, get_xdi_normalized_data_chunked, get_xdi_run_header, make_filename
+from export_tools import get_export_chunk_rows, tes_data_loaded
+from rixs_data import RIXSData
+from precision import apply_precision, get_precision_policy
 
 
 def transform_header(metadata):
@@ -19,13 +21,21 @@ def transform_header(metadata):
     return transformed
 
 
-def export_to_tiled(run, header_updates={}):
+def export_to_tiled(run, header_updates={}, memory_budget=None, precision_policy=None):
     """
     Export a run to a tiled catalog.
 
     Parameters
     ----------
+    run : Run
+    header_updates : dict
+    memory_budget : int or str, optional
+        Runs estimated to need more memory than this are read in chunks, see get_memory_budget
+    precision_policy : str or dict, optional
+        How columns are stored, see get_precision_policy. The policy is added to the metadata, and the policy applied
+        to each column to the attrs of its DataArray.
     """
+    import xarray as xr
 
     if "primary" not in run:
         print(f"Tiled Export does not support streams other than Primary, skipping {run.start['scan_id']}")
@@ -33,28 +43,45 @@ def export_to_tiled(run, header_updates={}):
     metadata = get_xdi_run_header(run, header_updates)
     print("Got XDI Metadata")
 
-    columns, run_data, metadata = get_xdi_normalized_data(run, metadata, omit_array_keys=False)
+    with tes_data_loaded(run, memory_budget):
+        chunk_rows = get_export_chunk_rows(run, memory_budget, omit_array_keys=False)
+        if chunk_rows is None:
+            table, metadata = get_xdi_normalized_data(run, metadata, omit_array_keys=False)
+        else:
+            print(f"Reading run in chunks of {chunk_rows} rows")
+            table, metadata = get_xdi_normalized_data_chunked(run, metadata, chunk_rows, omit_array_keys=False)
 
+    policy = get_precision_policy(precision_policy)
     da_dict = {}
-    for name, data in zip(columns, run_data):
+    for name, data in table.items():
         if name == "rixs":
-            if len(data) == 3:
-                counts, mono_grid, energy_grid = data
+            if isinstance(data, RIXSData):
+                # The counts come from TES processing emission energy first, the transpose is a view
+                counts, attrs = apply_precision(name, data.counts, policy)
                 rixs = xr.DataArray(
-                    counts.T, coords={"emission": energy_grid[:, 0]}, dims=("time", "emission"), name=name
+                    counts.T,
+                    coords={"emission": data.emission_energies},
+                    dims=("time", "emission"),
+                    name=name,
+                    attrs=attrs,
                 )
             else:
-                rixs = xr.DataArray(data, dims=("time", "emission"), name=name)
+                data, attrs = apply_precision(name, data, policy)
+                rixs = xr.DataArray(data, dims=("time", "emission"), name=name, attrs=attrs)
             da_dict[name] = rixs
         else:
-            da_dict[name] = xr.DataArray(data, dims=("time",), name=name)
+            data, attrs = apply_precision(name, data, policy)
+            da_dict[name] = xr.DataArray(data, dims=("time",), name=name, attrs=attrs)
 
     if "time" in da_dict:
         time_coord = da_dict.pop("time")
         for name, da in da_dict.items():
             da.coords["time"] = time_coord
-    da = xr.merge(da_dict.values())
+    # Built directly rather than with xr.merge, which copies the attrs of the first DataArray onto the Dataset, or
+    # with combine_attrs="drop" also drops the precision attrs of each DataArray
+    da = xr.Dataset(da_dict)
     metadata = transform_header(metadata)
+    metadata["precision_policy"] = policy
     data_session = run.start.get("data_session", None)
     if data_session is not None:
         metadata["data_session"] = data_session
@@ -1,7 +1,19 @@
 import numpy as np
+import os
 from os.path import exists, join
-from export_tools import get_with_fallbacks, get_run_data, add_comment_to_lines, sanitize_filename
+from export_tools import (
+    add_comment_to_lines,
+    get_run_data,
+    get_run_length,
+    get_with_fallbacks,
+    sanitize_filename,
+    tes_data_loaded,
+)
 from datetime import datetime
+from column_table import ColumnTable
+from rixs_data import RIXSData
+from export_index import get_energy_range, index_run_export
+from compressed_text import compressed_filename, open_text_output
 
 
 def get_config(config, keys, default=None):
@@ -85,44 +97,36 @@ def get_xdi_run_header(run, header_updates={}):
     return metadata
 
 
-def normalize_detector(search, replace, columns, header=None, description=None):
-    if search in columns:
-        columns[columns.index(search)] = replace
+def normalize_detector(search, replace, table, header=None, description=None):
+    if search in table:
+        table.rename(search, replace)
         if header is not None:
             if description is None:
                 description = search
             header[f"Detector.{replace}"] = description
 
 
-def exclude_column(search, columns, data):
-    if search in columns:
-        idx = columns.index(search)
-        columns.pop(idx)
-        data.pop(idx)
+def exclude_column(search, table):
+    if search in table:
+        table.drop(search)
 
 
-def reorder_columns(columns, data, key, index):
+def reorder_columns(table, key, index):
     """
-    Reorder columns and data to move a key to a specific index.
+    Reorder columns to move a key to a specific index. Only the column order changes, the data is not copied.
 
     Parameters
     ----------
-    columns : list
-        The list of column names.
-    data : list
-        The list of data arrays.
+    table : ColumnTable
+        The run data.
     key : str
         The key to move.
     index : int
         The index to move the key to.
     """
-    if key in columns:
-        key_idx = columns.index(key)
-        columns.pop(key_idx)
-        column_data = data.pop(key_idx)
-        columns.insert(index, key)
-        data.insert(index, column_data)
-    return columns, data
+    if key in table:
+        table.move(key, index)
+    return table
 
 
 def make_filename(folder, metadata, ext="xdi", suffix=None):
@@ -146,7 +150,7 @@ def make_filename(folder, metadata, ext="xdi", suffix=None):
     return filename
 
 
-def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
+def get_xdi_normalized_data(run, metadata, omit_array_keys=True, rows=None, tes_only=False, include_tes=True):
     """
     Get run data, and rename detectors to standard names for XDI export. Modify metadata in place.
 
@@ -156,89 +160,151 @@ def get_xdi_normalized_data(run, metadata, omit_array_keys=True):
         The run to normalize.
     metadata : dict
         The metadata to modify.
+    omit_array_keys : bool
+        If True, leave out multi-dimensional columns such as the TES spectrum.
+    rows : slice, optional
+        Only get this block of rows (scan points).
+    tes_only : bool
+        If True, only get the processed TES columns, see get_run_data.
+    include_tes : bool
+        If False, don't look up processed TES data, see get_run_data.
 
     Returns
     -------
-    columns : list
-        The column names to write to the XDI file.
-    run_data : np.ndarray
-        The data to write to the XDI file.
+    table : ColumnTable
+        The data to write to the XDI file, with normalized column names.
     metadata : dict
         The modified metadata.
     """
-    columns, run_data, tes_rois = get_run_data(
-        run, omit=["tes_scan_point_start", "tes_scan_point_end"], omit_array_keys=omit_array_keys
+    table, tes_rois = get_run_data(
+        run,
+        omit=["tes_scan_point_start", "tes_scan_point_end"],
+        omit_array_keys=omit_array_keys,
+        rows=rows,
+        tes_only=tes_only,
+        include_tes=include_tes,
     )
     print("Got XDI Data")
 
     # Insert tes_mca_pfy if tes_mca_counts is present but tes_mca_pfy is not
-    if "tes_mca_counts" in columns and "tes_mca_pfy" not in columns:
-        index = columns.index("tes_mca_counts") + 1
-        columns.insert(index, "tes_mca_pfy")
-        zero_array = np.zeros_like(run_data[index - 1])
-        run_data.insert(index, zero_array)
+    if "tes_mca_counts" in table and "tes_mca_pfy" not in table:
+        index = table.index("tes_mca_counts") + 1
+        table.insert(index, "tes_mca_pfy", np.zeros_like(table["tes_mca_counts"]))
 
     # Add TES ROI info
-    for c in columns:
+    for c in table.columns:
         if c in tes_rois:
             metadata[f"rois.{c}"] = "{:.2f} {:.2f}".format(*tes_rois[c])
 
     # Rename TFY and PFY channels
-    if "tes_mca_counts" in columns:
+    if "tes_mca_counts" in table:
         metadata["rois.tfy"] = metadata.pop("rois.tes_mca_counts", "")
         metadata["rois.pfy"] = metadata.pop("rois.tes_mca_pfy", "")
 
-    if "tes_mca_spectrum" in columns:
+    if "tes_mca_spectrum" in table:
         metadata["rois.rixs"] = metadata.pop("rois.tes_mca_spectrum", "")
 
     # Rename energy columns if present
     normalize_detector(
         "nexafs_i0up",
         "i0",
-        columns,
+        table,
         metadata,
         "Beam intensity normalization via drain current from NEXAFS upstream Au mesh",
     )
-    normalize_detector("nexafs_i1", "itrans", columns, metadata, "Transmission intensity via downstream diode")
+    normalize_detector("nexafs_i1", "itrans", table, metadata, "Transmission intensity via downstream diode")
     normalize_detector(
-        "nexafs_sc", "tey", columns, metadata, "Total electron yield via drain current from NEXAFS sample bar"
+        "nexafs_sc", "tey", table, metadata, "Total electron yield via drain current from NEXAFS sample bar"
     )
-    normalize_detector("nexafs_pey", "pey", columns, metadata, "Partial electron yield via NEXAFS Channeltron")
+    normalize_detector("nexafs_pey", "pey", table, metadata, "Partial electron yield via NEXAFS Channeltron")
     normalize_detector(
         "nexafs_ref",
         "iref",
-        columns,
+        table,
         metadata,
         "Energy reference via drain current from upstream multimesh reference samples",
     )
     normalize_detector(
-        "tes_mca_counts", "tfy", columns, metadata, "Total fluorescence yield via counts from TES detector"
+        "tes_mca_counts", "tfy", table, metadata, "Total fluorescence yield via counts from TES detector"
     )
 
+    normalize_detector("tes_mca_pfy", "pfy", table, metadata, "Partial fluorescence yield via counts from TES detector")
+    normalize_detector("tes_mca_spectrum", "rixs", table, metadata, "RIXS spectrum via TES detector")
     normalize_detector(
-        "tes_mca_pfy", "pfy", columns, metadata, "Partial fluorescence yield via counts from TES detector"
-    )
-    normalize_detector("tes_mca_spectrum", "rixs", columns, metadata, "RIXS spectrum via TES detector")
-    normalize_detector(
-        "m4cd", "i0_m4cd", columns, metadata, "Drain current from M4 mirror, sometimes useful as a secondary i0"
+        "m4cd", "i0_m4cd", table, metadata, "Drain current from M4 mirror, sometimes useful as a secondary i0"
     )
-    normalize_detector("en_energy_setpoint", "energy", columns)
-    normalize_detector("seconds", "measurement_time", columns)
+    normalize_detector("en_energy_setpoint", "energy", table)
+    normalize_detector("seconds", "measurement_time", table)
     if metadata.get("Scan.motors", "") == "en_energy":
         metadata["Scan.motors"] = "energy"
-    if "energy" in columns:
-        normalize_detector("en_energy", "energy_readback", columns, metadata, "Monochromator energy encoder readback")
+    if "energy" in table:
+        normalize_detector("en_energy", "energy_readback", table, metadata, "Monochromator energy encoder readback")
     else:
-        normalize_detector("en_energy", "energy", columns)
-    exclude_column("ucal_sc", columns, run_data)
-    columns, run_data = reorder_columns(columns, run_data, metadata.get("Scan.motors", "time"), 0)
-    return columns, run_data, metadata
+        normalize_detector("en_energy", "energy", table)
+    exclude_column("ucal_sc", table)
+    reorder_columns(table, metadata.get("Scan.motors", "time"), 0)
+    return table, metadata
+
+
+def iter_xdi_normalized_chunks(run, metadata, chunk_rows, omit_array_keys=True):
+    """
+    Get normalized run data a block of rows at a time, for runs too large to hold in memory at once.
+
+    Parameters
+    ----------
+    run : Run
+        The run to normalize.
+    metadata : dict
+        The metadata to start from for each chunk, it is not modified.
+    chunk_rows : int
+        Number of rows (scan points) per chunk.
+    omit_array_keys : bool
+        If True, leave out multi-dimensional columns such as the TES spectrum.
+
+    Yields
+    ------
+    rows : slice
+        The rows of the run in this chunk.
+    table : ColumnTable
+        The data for the rows in this chunk.
+    metadata : dict
+        The normalized metadata.
+    """
+    npts = get_run_length(run)
+    with tes_data_loaded(run):
+        for start in range(0, npts, chunk_rows):
+            rows = slice(start, min(start + chunk_rows, npts))
+            table, chunk_metadata = get_xdi_normalized_data(
+                run, dict(metadata), omit_array_keys=omit_array_keys, rows=rows
+            )
+            yield rows, table, chunk_metadata
+
+
+def get_xdi_normalized_data_chunked(run, metadata, chunk_rows, omit_array_keys=True):
+    """
+    Same as get_xdi_normalized_data, but fetch the run a block of rows at a time into preallocated columns, so that
+    peak memory is the output plus one block instead of several copies of the whole run.
+    """
+    table = None
+    npts = get_run_length(run)
+    for rows, chunk_table, chunk_metadata in iter_xdi_normalized_chunks(run, metadata, chunk_rows, omit_array_keys):
+        if table is None:
+            table = ColumnTable.empty_like(chunk_table, npts)
+            if "rixs" in chunk_table and isinstance(chunk_table["rixs"], RIXSData):
+                table.set_array("rixs", RIXSData.empty(npts, chunk_table["rixs"]))
+        table.set_rows(rows, chunk_table)
+        if "rixs" in chunk_table and isinstance(chunk_table["rixs"], RIXSData):
+            table["rixs"].set_rows(rows, chunk_table["rixs"])
+    metadata.clear()
+    metadata.update(chunk_metadata)
+    return table, metadata
 
 
 def exportToXDI(
     folder,
     run,
     headerUpdates={},
+    compression=None,
 ):
     """
     Export data to the XAS-Data-Interchange (XDI) ASCII format.
@@ -253,6 +319,8 @@ def exportToXDI(
         Dictionary of additional header fields to update or add.
     verbose : bool
         If True, prints export status messages.
+    compression : str, optional
+        "gzip" or "zstd" to write a compressed file, see get_compression
 
     Returns
     -------
@@ -263,28 +331,67 @@ def exportToXDI(
         return False
     metadata = get_xdi_run_header(run, headerUpdates)
     print("Got XDI Metadata")
-    filename = make_filename(folder, metadata)
+    filename = compressed_filename(make_filename(folder, metadata), compression)
+
+    table, metadata = get_xdi_normalized_data(run, metadata)
+    write_xdi(filename, table, metadata, run.start.get("comment", ""), compression)
+    index_run_export(run, metadata, "xdi", filename, get_energy_range(table))
+
+
+def write_xdi(filename, table, metadata, comment="", compression=None):
+    """
+    Write normalized run data to an XDI file.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the XDI file to write.
+    table : ColumnTable
+        The run data, as returned by get_xdi_normalized_data. Only one-dimensional columns are written.
+    metadata : dict
+        The XDI header dictionary.
+    comment : str
+        Free-form comment written after the header fields.
+    compression : str, optional
+        "gzip" or "zstd" to compress the file, see open_text_output. The decompressed file is plain XDI.
+    """
+    # Rows are written straight from a view of the table, without stacking the columns into a new array
+    data = table.records()
+    fmtStr = generate_format_string([data[name] for name in data.dtype.names])
+    header_string = make_xdi_header(metadata, data.dtype.names, comment)
+    print(f"Exporting XDI to {filename}")
+    with open_text_output(filename, compression) as f:
+        f.write(header_string)
+        f.write("\n")
+        np.savetxt(f, data, fmt=fmtStr, delimiter=" ")
 
-    columns, run_data, metadata = get_xdi_normalized_data(run, metadata)
 
-    fmtStr = generate_format_string(run_data)
+def make_xdi_header(metadata, columns, comment=""):
+    """
+    Generate the XDI header, without a trailing newline.
 
-    data = np.vstack(run_data).T
-    colStr = " ".join(columns)
+    Parameters
+    ----------
+    metadata : dict
+        The XDI header dictionary.
+    columns : list
+        The names of the columns written to the file.
+    comment : str
+        Free-form comment written after the header fields.
 
+    Returns
+    -------
+    str
+        The header lines.
+    """
     header_lines = ["# XDI/1.0 SST-1-NEXAFS/1.0"]
     for key, value in metadata.items():
         header_lines.append(f"# {key}: {value}")
     header_lines.append("# ///")
-    header_lines.append(add_comment_to_lines(run.start.get("comment", "")))
+    header_lines.append(add_comment_to_lines(comment))
     header_lines.append("#" + "-" * 50)
-    header_lines.append("# " + colStr)
-    header_string = "\n".join(header_lines)
-    print(f"Exporting XDI to {filename}")
-    with open(filename, "w") as f:
-        f.write(header_string)
-        f.write("\n")
-        np.savetxt(f, data, fmt=fmtStr, delimiter=" ")
+    header_lines.append("# " + " ".join(columns))
+    return "\n".join(header_lines)
 
 
 def generate_format_string(data):
@@ -321,3 +428,98 @@ def generate_format_string(data):
             formats.append("%11.4e")
 
     return " ".join(formats)
+
+
+class LiveXDIWriter:
+    """
+    Append rows to an XDI export while the run is still in progress.
+
+    Rows are written to a body file as they arrive, with every value written exactly. The header and the column
+    formats depend on the whole run, so they are only chosen by finalize, which reads the body back and writes the
+    finished file, ready to be published, as write_xdi would. Columns that only exist once the run has finished, such
+    as processed TES data, can be added to the rows with add_columns before finalize.
+
+    Parameters
+    ----------
+    filename : str
+        Final path of the XDI file, without any compression suffix.
+    compression : str, optional
+        "gzip" or "zstd" to compress the finished file, see get_compression. Rows are appended uncompressed while
+        the run is in progress.
+    """
+
+    def __init__(self, filename, compression=None):
+        self.filename = compressed_filename(filename, compression)
+        self.compression = compression
+        self.columns = None
+        self._dtype = None
+        self._fmt = None
+        self._added = None
+        self._body = open(filename + ".body.part", "w")
+
+    def append(self, table):
+        """
+        Append the one-dimensional columns of a block of rows, normalized by get_xdi_normalized_data.
+        """
+        data = table.records()
+        if self.columns is None:
+            self.columns = data.dtype.names
+            self._dtype = np.dtype([(name, data.dtype.fields[name][0]) for name in self.columns])
+            # Enough digits to read every value back exactly, the formats of the file are chosen by finalize
+            self._fmt = " ".join("%d" if self._dtype[name].kind in "iu" else "%.17g" for name in self.columns)
+        elif data.dtype.names != self.columns:
+            raise ValueError(f"XDI columns changed from {self.columns} to {data.dtype.names} during the run")
+        np.savetxt(self._body, data, fmt=self._fmt, delimiter=" ")
+        self._body.flush()
+
+    def add_columns(self, table, columns):
+        """
+        Add columns for every row appended so far, replacing any appended columns of the same name.
+
+        Parameters
+        ----------
+        table : ColumnTable
+            The columns to add, normalized by get_xdi_normalized_data for the whole run.
+        columns : list of str
+            The order of all columns in the finished file, e.g. from a normalized table with no rows.
+        """
+        self._added = (table, list(columns))
+
+    def finalize(self, metadata, comment=""):
+        """
+        Write the header followed by the rows appended so far, formatted as write_xdi would.
+
+        Returns
+        -------
+        str
+            Path of the finished partial file, to be moved to self.filename
+        """
+        self._body.close()
+        partial_filename = self.filename + ".part"
+        write_xdi(partial_filename, self._read_rows(), metadata, comment, self.compression)
+        os.remove(self._body.name)
+        return partial_filename
+
+    def _read_rows(self):
+        """
+        Read the rows back from the body file at their original dtypes, and merge in any added columns. Only the
+        one-dimensional columns of an XDI file are read, so this is cheap next to the run.
+        """
+        body = np.loadtxt(self._body.name, dtype=self._dtype, ndmin=1)
+        if self._added is None:
+            return ColumnTable(list(self.columns), [body[name] for name in self.columns])
+        added, columns = self._added
+        added_data = added.records()
+        if body.shape[0] != added_data.shape[0]:
+            raise ValueError(f"Added columns have {added_data.shape[0]} rows, but {body.shape[0]} were appended")
+        values = {name: body[name] for name in self.columns}
+        values.update({name: added_data[name] for name in added_data.dtype.names})
+        missing = [name for name in columns if name not in values]
+        if missing:
+            raise ValueError(f"No data for XDI columns {missing}")
+        return ColumnTable(columns, [values[name] for name in columns])
+
+    def discard(self):
+        self._body.close()
+        if os.path.exists(self._body.name):
+            os.remove(self._body.name)
@@ -1,16 +1,43 @@
 import datetime
 import numpy as np
+from column_table import ColumnTable
+from rixs_data import RIXSData, compact_rixs
+import os
+from contextlib import contextmanager
 from os.path import join
-from tiled.client import from_uri
-from autoprocess.statelessAnalysis import get_tes_data, get_tes_rois
-from autoprocess.utils import run_is_processed
+from prefect.utilities.hashing import hash_objects
 import re
+import resource
+import tempfile
+import threading
+
+# Processed TES data handed from process_tes to the exporters within one worker, keyed by uid
+_tes_data_cache = {}
+
+KNOWN_ARRAY_KEYS = ["tes_mca_spectrum", "spectrum"]
+
+# Memory budget for exporting one run, overridden by the UCAL_EXPORT_MEMORY_BUDGET environment variable
+DEFAULT_MEMORY_BUDGET = "8GB"
+# The exporters hold roughly this many copies of the run data at their peak
+EXPORT_MEMORY_OVERHEAD = 3
 
 
 def initialize_tiled_client(beamline_acronym):
+    from tiled.client import from_uri
+
     return from_uri("https://tiled.nsls2.bnl.gov")[beamline_acronym]["raw"]
 
 
+def flow_run_cache_key(context, parameters):
+    """
+    Cache key scoped to a single flow run, so that a retry of the flow reuses the results of tasks that already
+    finished. Only the small identifying parameters (uid, paths, flags) are hashed, so that metadata dicts passed
+    between tasks are not serialized just to compute the key.
+    """
+    keys = {k: v for k, v in parameters.items() if isinstance(v, (str, int, float, bool, type(None)))}
+    return f"{context.task_run.flow_run_id}-{context.task.task_key}-{hash_objects(keys)}"
+
+
 def get_proposal_path(run):
     proposal = run.start.get("proposal", {}).get("proposal_id", None)
     is_commissioning = "commissioning" in run.start.get("proposal", {}).get("type", "").lower()
@@ -24,6 +51,26 @@ def get_proposal_path(run):
     return proposal_path
 
 
+def get_export_path(run):
+    proposal_path = get_proposal_path(run)
+
+    visit_date = datetime.datetime.fromisoformat(run.start.get("start_datetime", datetime.datetime.today().isoformat()))
+    visit_dir = visit_date.strftime("%Y%m%d_export")
+
+    export_path = join(proposal_path, visit_dir)
+    return export_path
+
+
+def get_profile_path(run):
+    """
+    Directory for profiles of a run's flows, next to its export. None if the run has no proposal metadata.
+    """
+    try:
+        return join(get_export_path(run), "profiles")
+    except ValueError:
+        return None
+
+
 def get_with_fallbacks(thing, *possible_names, default=None):
     for name in possible_names:
         if isinstance(name, (list, tuple)):
@@ -40,11 +87,250 @@ def get_with_fallbacks(thing, *possible_names, default=None):
     return default
 
 
+def cache_tes_data(uid, tes_data):
+    """
+    Keep processed TES data in memory so that exporters in the same worker can skip reloading it from disk.
+
+    Parameters
+    ----------
+    uid : str
+        Unique identifier for the run the data belongs to
+    tes_data : dict
+        TES data keyed by column name, as returned by handle_run. RIXS grids are reduced to their axes, see RIXSData.
+    """
+    _tes_data_cache[uid] = {key: compact_rixs(value) for key, value in tes_data.items()}
+
+
+def get_cached_tes_data(uid):
+    return _tes_data_cache.get(uid, None)
+
+
+def release_tes_data(uid):
+    _tes_data_cache.pop(uid, None)
+
+
+def has_tes_data(run):
+    """
+    True if processed TES data is available for the run, either handed over by process_tes or on disk.
+    """
+    from autoprocess.utils import run_is_processed
+
+    if get_cached_tes_data(run.start["uid"]) is not None:
+        return True
+    return run_is_processed(run, join(get_proposal_path(run), "ucal_processing"))
+
+
+@contextmanager
+def tes_data_loaded(run, memory_budget=None):
+    """
+    Hold the processed TES data for a run while it is exported, so that it is read from disk once rather than once
+    per format or chunk, and so that the chunk size estimate includes it.
+
+    TES processing can only load a whole run. If the run with its TES data is over the memory budget (see
+    get_export_chunk_rows), multi-dimensional arrays are moved to memory-mapped files in a temporary directory as soon
+    as they are loaded, so each chunk only reads its own rows instead of the whole run staying in memory during the
+    export. Otherwise the data stays in memory. Data already handed over by process_tes is used as is.
+    """
+    from autoprocess.statelessAnalysis import get_tes_data
+    from autoprocess.utils import run_is_processed
+
+    uid = run.start["uid"]
+    save_directory = join(get_proposal_path(run), "ucal_processing")
+    if get_cached_tes_data(uid) is not None or not run_is_processed(run, save_directory):
+        yield
+        return
+    rois, tes_data = get_tes_data(run, save_directory, omit_array_keys=False)
+    cache_tes_data(uid, tes_data)
+    del tes_data
+    try:
+        if get_export_chunk_rows(run, memory_budget, omit_array_keys=False) is None:
+            yield
+        else:
+            with tempfile.TemporaryDirectory(prefix="ucal_tes_") as directory:
+                tes_data = get_cached_tes_data(uid)
+                cache_tes_data(uid, {key: spill_to_disk(value, directory, key) for key, value in tes_data.items()})
+                del tes_data
+                yield
+    finally:
+        release_tes_data(uid)
+
+
+def spill_to_disk(value, directory, name):
+    """
+    Move a multi-dimensional array, or the counts of RIXSData, to a memory-mapped .npy file in directory. Other
+    values are returned as is.
+    """
+    if isinstance(value, RIXSData):
+        return RIXSData(spill_to_disk(value.counts, directory, name), value.motor_values, value.emission_energies)
+    if not isinstance(value, np.ndarray) or value.ndim < 2:
+        return value
+    filename = join(directory, f"{name}.npy")
+    np.save(filename, value)
+    return np.load(filename, mmap_mode="r")
+
+
+def parse_bytes(size):
+    """
+    Convert a size such as 8000000000, "8GB" or "512 MiB" to a number of bytes.
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {"": 1, "b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12, "kib": 2**10, "mib": 2**20, "gib": 2**30}
+    match = re.fullmatch(r"\s*([\d.]+)\s*([a-zA-Z]*)\s*", str(size))
+    if match is None or match.group(2).lower() not in units:
+        raise ValueError(f"Could not parse size {size!r}")
+    return int(float(match.group(1)) * units[match.group(2).lower()])
+
+
+def get_memory_budget(memory_budget=None):
+    """
+    Memory budget for exporting one run in bytes. Taken from the argument if given, otherwise from the
+    UCAL_EXPORT_MEMORY_BUDGET environment variable, otherwise DEFAULT_MEMORY_BUDGET.
+    """
+    if memory_budget is None:
+        memory_budget = os.environ.get("UCAL_EXPORT_MEMORY_BUDGET", DEFAULT_MEMORY_BUDGET)
+    return parse_bytes(memory_budget)
+
+
+def get_run_length(run):
+    data = run.primary.data
+    key = "time" if "time" in data else list(data)[0]
+    return data[key].shape[0]
+
+
+def estimate_run_size(run, omit_array_keys=False):
+    """
+    Estimate the in-memory size of a run's primary stream from its Tiled structure, without reading any data, plus
+    the size of any processed TES data held for it (see estimate_tes_size).
+
+    Parameters
+    ----------
+    run : Run
+    omit_array_keys : bool, optional
+        If True, leave out the array keys that get_run_data would omit
+
+    Returns
+    -------
+    int
+        Estimated size in bytes
+    """
+    tes_data = get_cached_tes_data(run.start["uid"]) or {}
+    nbytes = estimate_tes_size(tes_data, omit_array_keys)
+    for key, array in run.primary.data.items():
+        # Keys in the TES data replace the primary stream's
+        if (key in KNOWN_ARRAY_KEYS and omit_array_keys) or key in tes_data:
+            continue
+        try:
+            nbytes += int(np.prod(array.shape)) * np.dtype(array.dtype).itemsize
+        except (AttributeError, TypeError):
+            continue
+    return nbytes
+
+
+def estimate_tes_size(tes_data, omit_array_keys=False):
+    """
+    Size in bytes of the processed TES data that get_run_data would read, counting memory-mapped arrays in full.
+
+    Only data held with cache_tes_data or tes_data_loaded is known here, so exports hold it with tes_data_loaded
+    before they choose a chunk size.
+    """
+    nbytes = 0
+    for key, value in tes_data.items():
+        if key in KNOWN_ARRAY_KEYS and omit_array_keys:
+            continue
+        if isinstance(value, RIXSData):
+            nbytes += value.counts.nbytes + value.motor_values.nbytes
+        elif isinstance(value, np.ndarray) and (value.ndim == 1 or not omit_array_keys):
+            nbytes += value.nbytes
+    return nbytes
+
+
+def get_export_chunk_rows(run, memory_budget=None, omit_array_keys=False):
+    """
+    Number of rows to export at a time so that an export stays within the memory budget.
+
+    Returns
+    -------
+    int or None
+        Rows per chunk, or None if the whole run fits in the budget and can be exported in one piece
+    """
+    budget = get_memory_budget(memory_budget)
+    nbytes = estimate_run_size(run, omit_array_keys) * EXPORT_MEMORY_OVERHEAD
+    if nbytes <= budget:
+        return None
+    npts = get_run_length(run)
+    return max(1, int(npts * budget / nbytes))
+
+
+def get_rss():
+    """
+    Current resident set size of this process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak rather than current RSS, but the best that is available without /proc
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def track_memory(stage, logger=None, interval=0.1):
+    """
+    Report the peak resident memory of the process while a stage runs.
+
+    RSS is sampled from a background thread, which is cheap enough to leave on for every run.
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, used in the report
+    logger : logging.Logger, optional
+        Logger to report to, prints if not given
+    interval : float, optional
+        Sampling interval in seconds
+    """
+    start = get_rss()
+    peak = [start]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], get_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        peak[0] = max(peak[0], get_rss())
+        message = f"{stage}: peak memory {peak[0] / 1e6:.1f} MB ({(peak[0] - start) / 1e6:+.1f} MB during stage)"
+        if logger is None:
+            print(message)
+        else:
+            logger.info(message)
+
+
+def take_rows(value, rows):
+    """
+    Select a block of rows (scan points) from a column.
+
+    RIXSData has its scan points along the second axis of the counts.
+    """
+    if rows is None:
+        return value
+    if isinstance(value, RIXSData):
+        return value.take(rows)
+    return value[rows]
+
+
 def get_header_and_data(run):
-    cols, run_data, rois = get_run_data(run)
+    table, rois = get_run_data(run)
     header = get_run_header(run)
-    header["channelinfo"]["cols"] = cols
-    data = np.vstack(run_data).T
+    header["channelinfo"]["cols"] = [name for name in table.columns if table.is_tabular(name)]
+    data = table.records()
     return header, data
 
 
@@ -90,7 +376,15 @@ def get_run_header(run):
     return metadata
 
 
-def get_run_data(run, omit=[], omit_array_keys=True):
+def get_run_data(run, omit=[], omit_array_keys=True, rows=None, tes_only=False, include_tes=True):
+    """
+    Read the columns of a run's primary stream and its processed TES data, which replaces primary keys of the same
+    name. If tes_only is True only the TES columns are returned, without reading the primary stream. If include_tes
+    is False the TES data is not looked up at all, e.g. for a run still in progress, which can't have been processed.
+    """
+    from autoprocess.statelessAnalysis import get_tes_data, get_tes_rois
+    from autoprocess.utils import run_is_processed
+
     first_keys = [
         "en_energy_setpoint",
         "en_energy",
@@ -116,49 +410,67 @@ def get_run_data(run, omit=[], omit_array_keys=True):
     exposure = float(exposure)
     columns = []
     datadict = {}
-    known_array_keys = ["tes_mca_spectrum", "spectrum"]
 
     keys = run.primary.data.keys()
     usekeys = []
 
     for key in keys:
-        if key in known_array_keys and omit_array_keys:
+        if key in KNOWN_ARRAY_KEYS and omit_array_keys:
             continue
         usekeys.append(key)
-    data = run.primary.data.read(usekeys)
+    if tes_only:
+        data = {}
+    elif rows is None:
+        data = run.primary.data.read(usekeys)
+    else:
+        # Only fetch the requested block of rows from Tiled
+        data = {key: run.primary.data[key][rows] for key in usekeys}
     # Add a try-except here after testing
     save_directory = join(get_proposal_path(run), "ucal_processing")
 
-    if run_is_processed(run, save_directory):
+    tes_data = get_cached_tes_data(run.start["uid"])
+    if not include_tes:
+        rois, tes_data = {}, {}
+    elif tes_data is not None:
+        rois = get_tes_rois(run, omit_array_keys=omit_array_keys)
+    elif run_is_processed(run, save_directory):
         rois, tes_data = get_tes_data(run, save_directory, omit_array_keys=omit_array_keys)
     else:
         print(f"No TES Data is Processed for {run.start['scan_id']}")
         rois = get_tes_rois(run, omit_array_keys=omit_array_keys)
         tes_data = {}
     for key in rois:
+        # TES data handed over by process_tes always includes the array keys
+        if key in KNOWN_ARRAY_KEYS and omit_array_keys:
+            continue
         if key not in usekeys and key in tes_data:
             usekeys.append(key)
+    if tes_only:
+        usekeys = [key for key in usekeys if key in tes_data]
     for key in usekeys:
         if key in tes_data:
             if key == "tes_mca_spectrum":
                 if not omit_array_keys:
-                    datadict[key] = tes_data[key]
+                    datadict[key] = take_rows(compact_rixs(tes_data[key]), rows)
                 else:
                     continue
             else:
                 try:
                     if len(tes_data[key].shape) == 1 or not omit_array_keys:
-                        datadict[key] = tes_data[key]
+                        datadict[key] = take_rows(tes_data[key], rows)
                 except:
                     continue
         else:
             try:
                 if len(data[key].shape) == 1 or not omit_array_keys:
-                    datadict[key] = data[key].data
+                    datadict[key] = np.asarray(data[key])
             except:
                 continue
-    if "seconds" not in datadict:
-        datadict["seconds"] = np.zeros_like(datadict[key]) + exposure
+    if "seconds" not in datadict and not tes_only:
+        # Sized from a 1-D column, the last key read may be an array key such as tes_mca_spectrum
+        length_key = "time" if "time" in datadict else next((k for k in datadict if np.ndim(datadict[k]) == 1), None)
+        if length_key is not None:
+            datadict["seconds"] = np.full(len(datadict[length_key]), exposure)
     for k in first_keys:
         if k in datadict.keys() and k not in omit:
             columns.append(k)
@@ -168,8 +480,7 @@ def get_run_data(run, omit=[], omit_array_keys=True):
     for k in last_keys:
         if k in datadict.keys() and k not in omit:
             columns.append(k)
-    data = [datadict[k] for k in columns]
-    return columns, data, rois
+    return ColumnTable(columns, [datadict[k] for k in columns]), rois
 
 
 def add_comment_to_lines(multiline_string, comment_char="#"):
@@ -0,0 +1,220 @@
+import time
+
+from prefect import flow, get_run_logger
+from os.path import join
+from end_of_run_export import (
+    claim_export,
+    create_export_path,
+    exporting,
+    get_export_state_path,
+    publish_export,
+)
+from export_to_hdf5 import LiveHDF5Writer
+from export_index import get_energy_range, index_run_export, merge_energy_range
+from export_to_xdi import LiveXDIWriter, get_xdi_normalized_data, get_xdi_run_header, make_filename
+from export_tools import (
+    get_export_path,
+    get_run_length,
+    has_tes_data,
+    initialize_tiled_client,
+    release_tes_data,
+    tes_data_loaded,
+)
+from process_tes import process_tes
+
+# Seconds a run may go without new rows or a stop document before the live export gives up on it
+LIVE_EXPORT_IDLE_TIMEOUT = 3600
+
+
+def open_live_writers(run, precision_policy=None, text_compression=None):
+    base_export_path = get_export_path(run)
+    create_export_path(base_export_path)
+    metadata = get_xdi_run_header(run)
+    writers = {}
+    xdi_export_path = join(base_export_path, "xdi")
+    create_export_path(xdi_export_path)
+    writers["xdi"] = LiveXDIWriter(make_filename(xdi_export_path, metadata), text_compression)
+    hdf5_export_path = join(base_export_path, "hdf5")
+    create_export_path(hdf5_export_path)
+    writers["hdf5"] = LiveHDF5Writer(make_filename(hdf5_export_path, metadata, "hdf5"), precision_policy)
+    return writers, metadata
+
+
+def follow_run(
+    catalog,
+    uid,
+    writers,
+    poll_interval=5,
+    idle_timeout=LIVE_EXPORT_IDLE_TIMEOUT,
+    precision_policy=None,
+    text_compression=None,
+):
+    """
+    Append new rows of the primary stream to the live writers until the run has stopped.
+
+    Parameters
+    ----------
+    catalog : Container
+        Tiled catalog the run is in
+    uid : str
+        Unique identifier for the run
+    writers : dict
+        Filled with the live writers, keyed by format, once the first rows arrive
+    poll_interval : float, optional
+        Seconds to wait between checks for new rows
+    idle_timeout : float, optional
+        Give up with a TimeoutError if the run neither grows nor stops for this many seconds, e.g. because the
+        RunEngine died before writing a stop document. None follows the run for as long as it takes.
+    precision_policy : str or dict, optional
+        How HDF5 columns are stored, see get_precision_policy
+    text_compression : str, optional
+        "gzip" or "zstd" to compress the XDI file, see get_compression
+
+    Returns
+    -------
+    run : Run
+        The finished run
+    energy_range : tuple or None
+        Lowest and highest energy of the run
+    """
+    logger = get_run_logger()
+    energy_range = None
+    npts_written = 0
+    last_progress = time.monotonic()
+    while True:
+        run = catalog[uid]
+        stopped = run.stop is not None
+        npts = get_run_length(run) if "primary" in run else 0
+        if npts > npts_written:
+            if not writers:
+                new_writers, header = open_live_writers(run, precision_policy, text_compression)
+                writers.update(new_writers)
+            rows = slice(npts_written, npts)
+            # One read feeds both formats, the XDI writer only uses the one-dimensional columns. TES data is only
+            # processed once the run has finished, so it is not looked up yet.
+            table, _ = get_xdi_normalized_data(run, dict(header), omit_array_keys=False, rows=rows, include_tes=False)
+            writers["xdi"].append(table)
+            writers["hdf5"].append(table)
+            energy_range = merge_energy_range(energy_range, get_energy_range(table))
+            logger.info(f"Exported rows {npts_written} to {npts}")
+            npts_written = npts
+            last_progress = time.monotonic()
+        elif stopped:
+            return run, energy_range
+        elif idle_timeout is not None and time.monotonic() - last_progress > idle_timeout:
+            raise TimeoutError(f"No new data or stop document for {uid} in {idle_timeout} s")
+        else:
+            time.sleep(poll_interval)
+
+
+@flow
+def live_export_workflow(
+    start_doc,
+    beamline_acronym="ucal",
+    reprocess_tes=False,
+    poll_interval=5,
+    idle_timeout=LIVE_EXPORT_IDLE_TIMEOUT,
+    precision_policy=None,
+    text_compression=None,
+):
+    """
+    Export a run to XDI and HDF5 while it is still being taken.
+
+    Meant to be triggered by the start document. Rows of the primary stream are appended to the exports as they
+    arrive. TES columns only exist after processing at the end of the run, so once the stop document is in they are
+    added to the rows already written, and the headers are written.
+
+    The flow claims the export of the run (see claim_export), so end_of_run_workflow waits for it and skips TES
+    processing and export once it has published the run, unless asked to reprocess or re-export it, and takes over
+    if the live export fails. A run that goes idle_timeout seconds without new rows or a stop document, such as a
+    paused scan or one whose RunEngine crashed, is given up on and its export recorded as failed, so that
+    end_of_run_workflow exports it if it does finish.
+    """
+    uid = start_doc["uid"]
+    logger = get_run_logger()
+    catalog = initialize_tiled_client(beamline_acronym)
+    run = catalog[uid]
+    if run.start.get("data_session", "") == "":
+        logger.info("No data session found, skipping export")
+        return
+
+    # Claimed for the whole flow, so the end-of-run flow waits for it instead of exporting the run a second time
+    state_path = get_export_state_path(run)
+    if not claim_export(state_path, "live"):
+        logger.info("Run is already being exported, skipping live export")
+        return
+    with exporting(state_path, "live") as status:
+        writers = {}
+        try:
+            try:
+                run, energy_range = follow_run(
+                    catalog, uid, writers, poll_interval, idle_timeout, precision_policy, text_compression
+                )
+            except TimeoutError as e:
+                logger.warning(f"{e}, giving up on the live export")
+                status["state"] = "failed"
+                return
+            exit_status = run.stop.get("exit_status", "No Status")
+            if exit_status != "success":
+                logger.info(f"Run had exit status: {exit_status}, skipping export")
+                status["state"] = "skipped"
+                return
+            if not writers:
+                logger.info(f"No Primary stream for {run.start['scan_id']}, skipping export")
+                status["state"] = "skipped"
+                return
+
+            process_tes(uid, beamline_acronym, reprocess=reprocess_tes, keep_data=True)
+            with tes_data_loaded(run):
+                layouts, metadata = get_finished_layouts(run)
+                if has_tes_data(run):
+                    logger.info("Adding processed TES columns to the exported rows")
+                    add_tes_columns(run, writers, layouts)
+
+            # Only the headers are left to write
+            xdi_writer = writers["xdi"]
+            partial_filename = xdi_writer.finalize(metadata["xdi"], run.start.get("comment", ""))
+            del writers["xdi"]
+            publish_export(partial_filename, xdi_writer.filename)
+            index_run_export(run, metadata["xdi"], "xdi", xdi_writer.filename, energy_range, logger)
+            hdf5_writer = writers["hdf5"]
+            partial_filename = hdf5_writer.finalize(metadata["hdf5"])
+            del writers["hdf5"]
+            publish_export(partial_filename, hdf5_writer.filename)
+            index_run_export(run, metadata["hdf5"], "hdf5", hdf5_writer.filename, energy_range, logger)
+            status["state"] = "published"
+        finally:
+            for writer in writers.values():
+                writer.discard()
+            release_tes_data(uid)
+
+
+def get_finished_layouts(run):
+    """
+    Column layout and normalized metadata of each format for the finished run, keyed by format.
+
+    They are taken from the run normalized with no rows, including any processed TES data, so the finished files have
+    the same columns and header as an export of the whole run without reading the primary stream again.
+    """
+    header = get_xdi_run_header(run)
+    layouts = {}
+    metadata = {}
+    for fmt, omit_array_keys in (("xdi", True), ("hdf5", False)):
+        layouts[fmt], metadata[fmt] = get_xdi_normalized_data(
+            run, dict(header), omit_array_keys=omit_array_keys, rows=slice(0, 0)
+        )
+    return layouts, metadata
+
+
+def add_tes_columns(run, writers, layouts):
+    """
+    Add the processed TES columns of a finished run to the live writers, in the column order of layouts, see
+    get_finished_layouts.
+    """
+    header = get_xdi_run_header(run)
+    for fmt, omit_array_keys in (("xdi", True), ("hdf5", False)):
+        tes_table, _ = get_xdi_normalized_data(run, dict(header), omit_array_keys=omit_array_keys, tes_only=True)
+        if fmt == "xdi":
+            writers[fmt].add_columns(tes_table, layouts[fmt].records().dtype.names)
+        else:
+            writers[fmt].add_columns(tes_table)
@@ -0,0 +1,190 @@
+import json
+import os
+from fnmatch import fnmatchcase
+
+import numpy as np
+
+# Columns that hold detector counts, stored as the narrowest signed integer type that holds them exactly
+COUNT_COLUMNS = ["tfy", "pfy", "rixs", "tes_*"]
+# Columns that hold drain currents and yields, which may be stored as float32 on request
+CURRENT_COLUMNS = ["i0", "itrans", "tey", "pey", "iref", "i0_m4cd"]
+
+# Largest relative error allowed by default when a column is stored as float32
+FLOAT32_RTOL = 1e-6
+
+# Named policies, overridden by the UCAL_PRECISION_POLICY environment variable. The default is lossless.
+PRECISION_POLICIES = {
+    "lossless": {pattern: "integer" for pattern in COUNT_COLUMNS},
+    "float32": {
+        **{pattern: "integer" for pattern in COUNT_COLUMNS},
+        **{pattern: "float32" for pattern in CURRENT_COLUMNS},
+    },
+    "keep": {},
+}
+DEFAULT_PRECISION_POLICY = "lossless"
+
+
+def get_precision_policy(policy=None):
+    """
+    Precision policy for exported columns, mapping column names or glob patterns to how the column is stored.
+
+    Each column is stored according to the entry for its name, or else the first pattern that matches it, or at its
+    source dtype if none does:
+
+    - "keep": the source dtype
+    - "integer": the narrowest signed integer type that holds every value exactly, if all values are integers.
+      Signed, so that differences such as tfy - background do not wrap around.
+    - "float32" or "float32:<rtol>": float32, if no value changes by more than rtol (FLOAT32_RTOL by default)
+
+    Columns that don't meet the condition of their policy are stored at their source dtype, so no policy loses more
+    precision than it allows.
+
+    Parameters
+    ----------
+    policy : str or dict, optional
+        The name of a policy in PRECISION_POLICIES, or a dict of column policies that take precedence over the default
+        policy. Taken from the UCAL_PRECISION_POLICY environment variable if not given, which may hold either, as JSON
+        for a dict.
+
+    Returns
+    -------
+    dict
+    """
+    if policy is None:
+        policy = os.environ.get("UCAL_PRECISION_POLICY", DEFAULT_PRECISION_POLICY)
+        if policy.lstrip().startswith("{"):
+            policy = json.loads(policy)
+    if isinstance(policy, str):
+        if policy not in PRECISION_POLICIES:
+            raise ValueError(f"Unknown precision policy {policy!r}, expected one of {', '.join(PRECISION_POLICIES)}")
+        return dict(PRECISION_POLICIES[policy])
+    for column_policy in policy.values():
+        parse_column_policy(column_policy)
+    return {**policy, **{k: v for k, v in PRECISION_POLICIES[DEFAULT_PRECISION_POLICY].items() if k not in policy}}
+
+
+def parse_column_policy(column_policy):
+    """
+    Split a column policy into its kind and its relative error bound, which is None except for float32.
+    """
+    kind, _, rtol = column_policy.partition(":")
+    if kind not in ("keep", "integer", "float32") or (rtol and kind != "float32"):
+        raise ValueError(f"Unknown column precision policy {column_policy!r}")
+    if kind == "float32":
+        return kind, float(rtol) if rtol else FLOAT32_RTOL
+    return kind, None
+
+
+def get_column_policy(name, policy):
+    """
+    The policy that applies to a column, matching exact names before glob patterns.
+    """
+    if name in policy:
+        return policy[name]
+    for pattern, column_policy in policy.items():
+        if fnmatchcase(name, pattern):
+            return column_policy
+    return "keep"
+
+
+def narrowest_integer_dtype(data):
+    """
+    The smallest signed integer dtype that holds every value of data exactly, or None if a value is not an integer
+    or does not fit in int64.
+    """
+    if data.size == 0 or data.dtype.kind not in "iuf":
+        return None
+    if data.dtype.kind == "f":
+        if not np.all(np.isfinite(data)) or not np.all(data == np.round(data)):
+            return None
+    low, high = int(data.min()), int(data.max())
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return None
+
+
+def float32_error(data):
+    """
+    Largest relative change of any value of data when stored as float32. NaN values are ignored.
+    """
+    if data.size == 0:
+        return 0.0
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        data32 = data.astype(np.float32)
+        error = np.abs(data32 - data)
+        nonzero = data != 0
+        error[nonzero] /= np.abs(data[nonzero])
+    error = error[~np.isnan(data)]
+    if error.size == 0:
+        return 0.0
+    if np.any(np.isnan(error)):
+        return float("inf")
+    return float(error.max())
+
+
+def choose_dtype(name, data, policy):
+    """
+    Choose the dtype to store a column at under a precision policy.
+
+    Parameters
+    ----------
+    name : str
+        The column name
+    data : np.ndarray
+        The column data, or a block of rows of it
+    policy : dict
+        A precision policy, see get_precision_policy
+
+    Returns
+    -------
+    dtype : np.dtype
+        The dtype to store the data at
+    attrs : dict
+        The policy applied, the source dtype, and for float32 the largest relative error, to be stored with the data
+    """
+    data = np.asarray(data)
+    column_policy = get_column_policy(name, policy)
+    kind, rtol = parse_column_policy(column_policy)
+    attrs = {"precision": column_policy, "source_dtype": str(data.dtype)}
+    dtype = data.dtype
+    if kind == "integer":
+        integer_dtype = narrowest_integer_dtype(data)
+        if integer_dtype is not None:
+            dtype = integer_dtype
+    elif kind == "float32" and data.dtype.kind == "f" and data.dtype.itemsize > 4:
+        error = float32_error(data)
+        if error <= rtol:
+            dtype = np.dtype(np.float32)
+            attrs["max_relative_error"] = error
+    return np.dtype(dtype), attrs
+
+
+def apply_precision(name, data, policy):
+    """
+    Convert a column to the dtype chosen by choose_dtype. Returns the converted data and the attrs to store with it.
+    """
+    data = np.asarray(data)
+    dtype, attrs = choose_dtype(name, data, policy)
+    if dtype != data.dtype:
+        data = data.astype(dtype)
+    return data, attrs
+
+
+def merge_precision(dtype, attrs, other_dtype, other_attrs):
+    """
+    Combine the dtypes and attrs chosen for two blocks of rows of the same column into the ones choose_dtype would
+    choose for both blocks together.
+    """
+    source_dtype = np.promote_types(attrs["source_dtype"], other_attrs["source_dtype"])
+    error = max(attrs.get("max_relative_error", 0.0), other_attrs.get("max_relative_error", 0.0))
+    attrs = {**attrs, "source_dtype": str(source_dtype)}
+    attrs.pop("max_relative_error", None)
+    kind, _ = parse_column_policy(attrs["precision"])
+    # A column is only narrowed if every block is, as for the whole column at once
+    if kind == "integer" and dtype.kind == "i" and other_dtype.kind == "i":
+        return np.promote_types(dtype, other_dtype), attrs
+    if kind == "float32" and dtype == other_dtype == np.float32 and source_dtype != np.float32:
+        attrs["max_relative_error"] = error
+        return np.dtype(np.float32), attrs
+    return source_dtype, attrs
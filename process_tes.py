@@ -1,14 +1,13 @@
 from prefect import flow, get_run_logger
-from export_tools import get_proposal_path, initialize_tiled_client
-from autoprocess.statelessAnalysis import handle_run
-from autoprocess.utils import get_processing_info_file
+from export_tools import cache_tes_data, get_profile_path, get_proposal_path, initialize_tiled_client
+from profiling import profile_flow
 from os.path import dirname, join
 import os
 import pickle
 
 
 @flow(log_prints=True)
-def process_tes(uid, beamline_acronym="ucal", reprocess=False):
+def process_tes(uid, beamline_acronym="ucal", reprocess=False, profile=None, keep_data=False):
     """
     Process TES data and save processing information.
 
@@ -20,44 +19,58 @@ def process_tes(uid, beamline_acronym="ucal", reprocess=False):
         Beamline identifier
     reprocess : bool, optional
         If True, force reprocessing even if data already exists
+    profile : bool, optional
+        If True, save a profile of the processing next to the export, see profile_flow
+    keep_data : bool, optional
+        If True, keep the processed data in memory for exporters in the same worker, see cache_tes_data. The caller
+        then owns it and must free it with release_tes_data once the run is exported.
 
     Returns
     -------
     dict
         Processing information dictionary
     """
+    from autoprocess.statelessAnalysis import handle_run
+    from autoprocess.utils import get_processing_info_file
+
     logger = get_run_logger()
-    catalog = initialize_tiled_client(beamline_acronym)
-    run = catalog[uid]
-
-    if "primary" not in run:
-        logger.info(f"No Primary stream for {run.start['scan_id']}")
-        return False
-
-    logger.info(f"In TES Exporter for {run.start['uid']}")
-    save_directory = join(get_proposal_path(run), "ucal_processing")
-
-    # Process the run
-    processing_info, data = handle_run(uid, catalog, save_directory, reprocess=reprocess)
-    # Save calibration information
-    config_path = "/nsls2/data/sst/legacy/ucal/process_info"
-    try:
-        if "data_calibration_info" in processing_info:
-            cal_path = get_processing_info_file(config_path, "calibration")
-            os.makedirs(dirname(cal_path), exist_ok=True)
-
-            with open(cal_path, "wb") as f:
-                pickle.dump(processing_info["data_calibration_info"], f)
-            logger.info(f"Saved calibration info to {cal_path}")
-
-        # Save processing info if it exists
-        if "data_processing_info" in processing_info:
-            proc_path = get_processing_info_file(config_path, "processing")
-            os.makedirs(dirname(proc_path), exist_ok=True)
-
-            with open(proc_path, "wb") as f:
-                pickle.dump(processing_info["data_processing_info"], f)
-            logger.info(f"Saved processing info to {proc_path}")
-    except Exception as e:
-        logger.info(f"Could not write processing info: {e}")
-    return processing_info
+    with profile_flow("process_tes", profile, logger=logger) as flow_profile:
+        catalog = initialize_tiled_client(beamline_acronym)
+        run = catalog[uid]
+
+        if "primary" not in run:
+            logger.info(f"No Primary stream for {run.start['scan_id']}")
+            return False
+
+        if flow_profile is not None:
+            flow_profile.output_dir = get_profile_path(run)
+        logger.info(f"In TES Exporter for {run.start['uid']}")
+        save_directory = join(get_proposal_path(run), "ucal_processing")
+
+        # Process the run
+        processing_info, data = handle_run(uid, catalog, save_directory, reprocess=reprocess)
+        # Hand the processed data to the exporters so they don't have to read it back from disk
+        if keep_data and isinstance(data, dict) and data:
+            cache_tes_data(uid, data)
+        # Save calibration information
+        config_path = "/nsls2/data/sst/legacy/ucal/process_info"
+        try:
+            if "data_calibration_info" in processing_info:
+                cal_path = get_processing_info_file(config_path, "calibration")
+                os.makedirs(dirname(cal_path), exist_ok=True)
+
+                with open(cal_path, "wb") as f:
+                    pickle.dump(processing_info["data_calibration_info"], f)
+                logger.info(f"Saved calibration info to {cal_path}")
+
+            # Save processing info if it exists
+            if "data_processing_info" in processing_info:
+                proc_path = get_processing_info_file(config_path, "processing")
+                os.makedirs(dirname(proc_path), exist_ok=True)
+
+                with open(proc_path, "wb") as f:
+                    pickle.dump(processing_info["data_processing_info"], f)
+                logger.info(f"Saved processing info to {proc_path}")
+        except Exception as e:
+            logger.info(f"Could not write processing info: {e}")
+        return processing_info
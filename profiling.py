@@ -0,0 +1,282 @@
+import datetime
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from os.path import abspath, basename, dirname, join
+
+# Only stacks that pass through this repository are recorded, which leaves out idle worker and event loop threads
+REPO_DIRECTORY = dirname(abspath(__file__))
+
+# Innermost frames of threads that are blocked waiting, e.g. a flow waiting for its task to finish
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("base_events.py", "_run_once"),
+}
+
+# The profile currently being recorded, flows called from a profiled flow are covered by it
+_active_profile = None
+
+# Allocations are snapshot again whenever traced memory grows by this factor past the last snapshot
+PEAK_SNAPSHOT_GROWTH = 1.25
+
+
+def profiling_enabled(profile=None):
+    """
+    Whether to profile a flow run. Taken from the flow parameter if given, otherwise from the UCAL_PROFILE
+    environment variable.
+    """
+    if profile is None:
+        profile = os.environ.get("UCAL_PROFILE", "").lower() in ("1", "true", "yes", "on")
+    return bool(profile)
+
+
+class StackSampler:
+    """
+    Sampling profiler for all threads of the process.
+
+    Prefect runs tasks in worker threads, so the stacks of every thread are sampled from a background thread rather
+    than only profiling the thread that started the profile. Threads that are blocked waiting, and those in
+    ignored_threads, are left out.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between samples. Sampling a busy process takes longer than that, so times are reported from the
+        measured time per sample, see sample_time.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.nsamples = 0
+        self.elapsed = 0.0
+        self.ignored_threads = set()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+
+    @property
+    def sample_time(self):
+        """
+        Measured seconds between samples, which is longer than interval when sampling falls behind.
+        """
+        return self.elapsed / self.nsamples if self.nsamples else self.interval
+
+    def _run(self):
+        own_id = threading.get_ident()
+        start = time.monotonic()
+        while not self._done.wait(self.interval):
+            self.elapsed = time.monotonic() - start
+            self.nsamples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or thread_id in self.ignored_threads:
+                    continue
+                if (basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                in_repo = False
+                while frame is not None:
+                    code = frame.f_code
+                    in_repo = in_repo or code.co_filename.startswith(REPO_DIRECTORY)
+                    stack.append(f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if in_repo:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self):
+        """
+        Stacks in the collapsed "caller;callee count" format read by flamegraph.pl and speedscope.
+        """
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def summary(self, limit=25):
+        """
+        Functions with the most samples, inclusive of their callees and on their own.
+        """
+        inclusive = Counter()
+        exclusive = Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            for function in set(functions):
+                inclusive[function] += count
+            exclusive[functions[-1]] += count
+        sample_time = self.sample_time
+        lines = [
+            f"{self.nsamples} samples in {self.elapsed:.2f} s, one every {sample_time * 1000:.1f} ms "
+            f"({self.interval * 1000:.1f} ms requested)",
+            "",
+            "Inclusive time:",
+        ]
+        for function, count in inclusive.most_common(limit):
+            lines.append(f"{count * sample_time:9.3f} s  {function}")
+        lines += ["", "Self time:"]
+        for function, count in exclusive.most_common(limit):
+            lines.append(f"{count * sample_time:9.3f} s  {function}")
+        return "\n".join(lines)
+
+
+class FlowProfile:
+    """
+    Sampling profile and allocation statistics for one flow run, see profile_flow.
+
+    Exports free their data before the flow ends, so allocations are not snapshot at the end but close to the peak of
+    traced memory: a background thread polls the traced memory and takes a new snapshot each time it grows by
+    PEAK_SNAPSHOT_GROWTH past the last one. Tracing starts with the profile, so the snapshot only holds allocations
+    made by the flow that were still live at that point.
+
+    Attributes
+    ----------
+    output_dir : str or None
+        Directory the profile is saved to when it is finished, may be set while the flow runs
+    """
+
+    def __init__(self, name, output_dir=None, interval=0.005, memory_interval=0.05):
+        self.name = name
+        self.output_dir = output_dir
+        self.sampler = StackSampler(interval)
+        self.memory_interval = memory_interval
+        self.start_time = None
+        self.elapsed = None
+        self.allocations = None
+        self.snapshot = None
+        self.snapshot_traced = 0
+        self.peak_traced = None
+        self._done = threading.Event()
+        self._memory_thread = threading.Thread(target=self._watch_memory, daemon=True)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        tracemalloc.start()
+        self._memory_thread.start()
+        self.sampler.ignored_threads.add(self._memory_thread.ident)
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+        self._done.set()
+        self._memory_thread.join()
+        self._snapshot_if_peak()
+        self.peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.allocations = self.snapshot.statistics("lineno")
+        self.elapsed = time.monotonic() - self.start_time
+
+    def _watch_memory(self):
+        while not self._done.wait(self.memory_interval):
+            self._snapshot_if_peak()
+
+    def _snapshot_if_peak(self):
+        current = tracemalloc.get_traced_memory()[0]
+        if self.snapshot is None or current > self.snapshot_traced * PEAK_SNAPSHOT_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_traced = current
+
+    def allocation_summary(self, limit=25):
+        lines = [
+            f"Peak traced memory: {self.peak_traced / 1e6:.1f} MB",
+            "",
+            f"Largest live allocations near the peak, at {self.snapshot_traced / 1e6:.1f} MB traced:",
+        ]
+        for stat in self.allocations[:limit]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1e6:9.3f} MB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+        return "\n".join(lines)
+
+    def report(self):
+        return "\n".join(
+            [
+                f"Profile of {self.name}: {self.elapsed:.3f} s",
+                "",
+                self.sampler.summary(),
+                "",
+                self.allocation_summary(),
+            ]
+        )
+
+    def save(self):
+        """
+        Write the folded stacks and the text report to output_dir.
+
+        Returns
+        -------
+        list
+            Paths of the files written
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = join(self.output_dir, f"{self.name}_{datetime.datetime.now():%Y%m%d_%H%M%S}")
+        with open(prefix + ".folded", "w") as f:
+            f.write(self.sampler.folded())
+        with open(prefix + ".txt", "w") as f:
+            f.write(self.report())
+        return [prefix + ".folded", prefix + ".txt"]
+
+
+@contextmanager
+def profile_flow(name, profile=None, output_dir=None, logger=None):
+    """
+    Record a sampling profile and allocation statistics while a flow runs, if profiling is enabled.
+
+    The report is attached to the flow run as a markdown artifact, and saved together with the folded stacks for a
+    flame graph to output_dir if it is known by the end of the flow. Flows run from within a profiled flow are
+    included in its profile rather than profiled separately.
+
+    Parameters
+    ----------
+    name : str
+        Name for the profile, used in file names and the artifact key
+    profile : bool, optional
+        Enable profiling, see profiling_enabled
+    output_dir : str, optional
+        Directory to save the profile to, can also be set on the yielded profile while the flow runs
+    logger : logging.Logger, optional
+        Logger to report to, prints if not given
+
+    Yields
+    ------
+    FlowProfile or None
+        The profile being recorded, or None if profiling is disabled
+    """
+    global _active_profile
+    if not profiling_enabled(profile) or _active_profile is not None:
+        yield None
+        return
+
+    log = print if logger is None else logger.info
+    flow_profile = FlowProfile(name, output_dir)
+    _active_profile = flow_profile
+    flow_profile.start()
+    try:
+        yield flow_profile
+    finally:
+        flow_profile.stop()
+        _active_profile = None
+        report = flow_profile.report()
+        log(report)
+        if flow_profile.output_dir is not None:
+            try:
+                for path in flow_profile.save():
+                    log(f"Saved profile to {path}")
+            except OSError as e:
+                log(f"Could not save profile: {e}")
+        try:
+            from prefect.artifacts import create_markdown_artifact
+
+            create_markdown_artifact(
+                markdown=f"```\n{report}\n```",
+                key=f"profile-{name}".lower().replace("_", "-"),
+                description=f"Profile of {name}",
+            )
+        except Exception as e:
+            log(f"Could not attach profile artifact: {e}")
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class RIXSData:
+    """
+    RIXS counts from the TES detector with the 1-D axes they were binned on.
+
+    TES processing returns the counts together with two full 2-D meshgrids of the mono and emission energies, which
+    hold as much data as the counts themselves. Only one row and one column of those grids carry information, so this
+    keeps just the axes.
+
+    Parameters
+    ----------
+    counts : np.ndarray
+        Counts with shape (number of emission energies, number of scan points)
+    motor_values : np.ndarray
+        Value of the scanned motor (mono energy) at each scan point
+    emission_energies : np.ndarray
+        Emission energy of each row of counts
+    """
+
+    def __init__(self, counts, motor_values, emission_energies):
+        self.counts = counts
+        self.motor_values = motor_values
+        self.emission_energies = emission_energies
+
+    @classmethod
+    def from_grids(cls, counts, mono_grid, energy_grid):
+        """
+        Build from the (counts, mono_grid, energy_grid) tuple returned by TES processing.
+
+        The axes are copied out of the grids, so the grids can be freed.
+        """
+        return cls(counts, mono_grid[0, :].copy(), energy_grid[:, 0].copy())
+
+    @classmethod
+    def empty(cls, npts, like):
+        """
+        Allocate RIXS data for npts scan points with the same emission axis and dtypes as another one.
+        """
+        return cls(
+            np.empty((like.counts.shape[0], npts), dtype=like.counts.dtype),
+            np.empty(npts, dtype=like.motor_values.dtype),
+            like.emission_energies,
+        )
+
+    def take(self, rows):
+        """
+        Select a block of scan points, without copying.
+        """
+        return RIXSData(self.counts[:, rows], self.motor_values[rows], self.emission_energies)
+
+    def set_rows(self, rows, other):
+        """
+        Copy the scan points of another RIXSData into a block of scan points of this one.
+        """
+        self.counts[:, rows] = other.counts
+        self.motor_values[rows] = other.motor_values
+
+
+def compact_rixs(value):
+    """
+    Convert a (counts, mono_grid, energy_grid) tuple from TES processing to RIXSData. Other values are returned as is.
+    """
+    if isinstance(value, tuple) and len(value) == 3:
+        return RIXSData.from_grids(*value)
+    return value